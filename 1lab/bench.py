@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+from main import Server, Client, ENCODINGS, SORT_KEYS
+
+
+def make_path(root, directories, files): # синтетический PATH: directories директорий по files исполняемых файлов
+    path = []
+    for d in range(directories):
+        directory = os.path.join(root, f"bin{d}")
+        os.makedirs(directory, exist_ok=True)
+        for f in range(files):
+            file_path = os.path.join(directory, f"executable-{d}-{f:06d}")
+            with open(file_path, 'wb') as file:
+                file.write(b"#!/bin/sh\n")
+            os.chmod(file_path, 0o755)
+        path.append(directory)
+    return os.pathsep.join(path)
+
+
+def free_port(): # свободный порт для локального сервера
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(**kwargs): # сервер в фоновом потоке текущего процесса; вывод сервера заглушает вызывающий
+    port = free_port()
+    server = Server(port=port, **kwargs)
+    threading.Thread(target=server.start, daemon=True).start()
+    return server, port
+
+
+def connect(port, encodings=None):
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return Client(port=port, encodings=encodings)
+
+
+def start_server_process(root, args): # сервер отдельным процессом: его память и CPU не смешиваются с клиентами
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), "server",
+               "--port", str(port), "--workers", str(args.workers)]
+    if args.cache_size is not None:
+        command += ["--cache-size", str(args.cache_size)]
+    process = subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True: # ждем, пока сервер начнет принимать подключения
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("Сервер не запустился")
+            time.sleep(0.05)
+
+
+def rss_kb(pid): # резидентная память процесса из /proc (только Linux)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def percentiles(values): # перцентили задержек в мс
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1] * 1000, 3)}
+
+
+def make_operations(args, client_id, client): # последовательность команд клиента; с тем же seed она та же самая
+    rng = random.Random(args.seed * 1000 + client_id)
+    updates = ["UPDATE"] + [f"UPDATE {key}" for key in SORT_KEYS] # без сортировки и с каждым критерием
+    operations = []
+    for i in range(args.requests):
+        if rng.random() < args.set_ratio:
+            key, val = f"BENCH_{client_id}_{i % 8}", str(rng.randrange(10 ** 6))
+            operations.append(("SET", f"SET {key} {val} {client.make_hash(f'SET {key} {val}')}"))
+        else:
+            command = rng.choice(updates)
+            operations.append((command, command))
+    return operations
+
+
+def legacy_get_file(client): # прежний способ приема: data += packet по 1024 байта и decode перед json.loads
+    data = b""
+    while True:
+        size_data = b""
+        while len(size_data) < 4:
+            size_data += client.socket_cl.recv(4 - len(size_data))
+        frame_size = struct.unpack('!I', size_data)[0]
+        if frame_size == 0:
+            break
+        end = len(data) + frame_size
+        while len(data) < end:
+            data += client.socket_cl.recv(min(end - len(data), 1024))
+    client.last_response_size = len(data)
+    return json.loads(data.decode())
+
+
+def bench_receive(args): # скорость приема снимка UPDATE в МБ/с
+    client = connect(args.port)
+    client.send_request("UPDATE name") # прогрев: первое сканирование PATH не учитываем
+    client.get_file()
+    results = {}
+    for method, receive in (("recv_into", client.get_file), ("legacy", lambda: legacy_get_file(client))):
+        total_bytes = 0
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            client.send_request("UPDATE name")
+            receive()
+            total_bytes += client.last_response_size
+        elapsed = time.perf_counter() - start
+        results[method] = {"bytes": client.last_response_size, "seconds": elapsed / args.repeat,
+                           "mb_per_s": total_bytes / elapsed / 1e6}
+    client.socket_cl.close()
+    return results
+
+
+def bench_encodings(args): # размер ответа и время UPDATE (кодирование, передача, разбор) для каждого формата
+    results = {}
+    for encoding in ENCODINGS:
+        client = connect(args.port, [encoding])
+        client.send_request("UPDATE name") # прогрев: первое сканирование PATH не учитываем
+        client.get_file(client.encoding)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            client.send_request("UPDATE name")
+            client.get_file(client.encoding)
+        elapsed = time.perf_counter() - start
+        results[encoding] = {"bytes": client.last_response_size, "seconds": elapsed / args.repeat}
+        client.socket_cl.close()
+    return results
+
+
+def bench_load(args, root): # N одновременных клиентов со смесью UPDATE и SET против сервера в отдельном процессе
+    process, port = start_server_process(root, args)
+    try:
+        clients = [connect(port, [args.encoding]) for _ in range(args.clients)]
+        clients[0].send_request("UPDATE") # прогрев: первое сканирование PATH не учитываем
+        clients[0].recv_response()
+        samples = {} # команда -> [(задержка, размер ответа)]
+        samples_lock = threading.Lock()
+        barrier = threading.Barrier(args.clients + 1)
+        done = threading.Event()
+
+        def run_client(client_id):
+            client, results = clients[client_id], []
+            operations = make_operations(args, client_id, client)
+            barrier.wait()
+            for name, command in operations:
+                start = time.perf_counter()
+                client.send_request(command)
+                size = len(client.recv_response())
+                results.append((name, time.perf_counter() - start, size))
+            with samples_lock:
+                for name, latency, size in results:
+                    samples.setdefault(name, []).append((latency, size))
+
+        threads = [threading.Thread(target=run_client, args=(i,)) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        rss = [] # (секунды от начала, VmRSS сервера в КБ)
+
+        def sample_rss():
+            while not done.wait(args.sample_interval):
+                rss.append((round(time.perf_counter() - start, 3), rss_kb(process.pid)))
+
+        barrier.wait()
+        start = time.perf_counter()
+        sampler = threading.Thread(target=sample_rss)
+        sampler.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+        rss.append((round(elapsed, 3), rss_kb(process.pid)))
+        clients[0].send_request("STATS")
+        server_stats = json.loads(clients[0].recv_response())
+        for client in clients:
+            client.socket_cl.close()
+    finally:
+        process.terminate()
+        process.wait()
+    total = sum(len(values) for values in samples.values())
+    return {"clients": args.clients, "requests": total, "seconds": round(elapsed, 3),
+            "throughput_rps": round(total / elapsed, 1),
+            "latency_ms": {name: percentiles([latency for latency, _ in values]) for name, values in sorted(samples.items())},
+            "payload_bytes": {name: {"min": min(size for _, size in values), "max": max(size for _, size in values),
+                                     "mean": round(sum(size for _, size in values) / len(values))}
+                              for name, values in sorted(samples.items())},
+            "server_rss_kb": rss,
+            "server_stats": server_stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки протокола 1lab")
+    parser.add_argument("benchmark", choices=["receive", "encodings", "load"])
+    parser.add_argument("--directories", type=int, default=20, help="число директорий в синтетическом PATH")
+    parser.add_argument("--files", type=int, default=2000, help="число исполняемых файлов в каждой директории")
+    parser.add_argument("--system-path", action="store_true", help="использовать настоящий PATH вместо синтетического")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=16, help="load: число одновременных клиентов")
+    parser.add_argument("--requests", type=int, default=200, help="load: число команд каждого клиента")
+    parser.add_argument("--set-ratio", type=float, default=0.1, help="load: доля команд SET, остальные - UPDATE")
+    parser.add_argument("--encoding", default="json", choices=ENCODINGS, help="load: формат ответов UPDATE")
+    parser.add_argument("--workers", type=int, default=8, help="load: потоки сервера")
+    parser.add_argument("--cache-size", type=int, help="load: кеш ответов сервера, МБ (0 - без кеша)")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="load: период замера памяти сервера, с")
+    parser.add_argument("--seed", type=int, default=1, help="load: зерно последовательности команд")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        if not args.system_path:
+            os.environ["PATH"] = make_path(root, args.directories, args.files)
+        os.chdir(root) # журналы и история сервера пишутся во временную директорию
+        if args.benchmark == "load":
+            results = bench_load(args, root)
+        else:
+            # сервер печатает о подключениях из своего потока: stdout заглушен, пока он работает, чтобы не смешать вывод с JSON
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                server, args.port = start_server()
+                results = {"receive": bench_receive, "encodings": bench_encodings}[args.benchmark](args)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,153 +1,1124 @@
 import os 
 import json 
+import errno
 import socket 
 import struct 
 import logging 
+import logging.handlers
 from datetime import datetime
 import hashlib 
 import threading
-import sys
+import stat
+import zlib
+import time
+import heapq
+import bisect
+import fnmatch
+import itertools
+import select
+import ctypes
+import ctypes.util
+import selectors
+import queue
+import argparse
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+CHUNK_SIZE = 256 * 1024 # размер кадра потокового ответа
+RECV_SIZE = 1024 * 1024 # максимальный размер одного чтения из сокета на клиенте
+MAX_COMMAND_SIZE = 16 * 1024 * 1024 # ограничение размера одной команды
+WATCH_DEBOUNCE = 0.05 # пауза для накопления пачки событий inotify, с
+WATCH_QUEUE_SIZE = 1024 # сколько неотправленных событий WATCH может накопиться у подписчика, дальше он отключается
+WATCH_SEND_TIMEOUT = 1.0 # сколько ждать, пока подписчик освободит буфер сокета под событие, с
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0) # на Windows флага нет, там события отправляются блокирующе
+MAX_VERSIONS = 32 # сколько последних версий снимка сервер помнит для UPDATE SINCE
+FILES_PER_PIECE = 512 # сколько файлов директории кодируется в JSON за раз
+RESPONSE_CACHE_SIZE = 64 * 1024 * 1024 # примерный предел памяти кеша готовых ответов UPDATE
+RESPONSE_CACHE_TTL = 2.0 # сколько секунд готовый ответ считается актуальным без проверки PATH
+
+SORT_KEYS = ("name", "size", "mtime") # критерии сортировки UPDATE
+ENCODINGS = ("json", "columnar", "json+zlib", "columnar+zlib") # форматы ответов UPDATE, json - по умолчанию
+ZLIB_LEVEL = 6
+COMMANDS = ("UPDATE", "SET", "MSET", "VARS", "HISTORY", "HELLO", "WATCH", "UNWATCH", "STATS") # команды в статистике STATS
+LATENCY_BUCKETS = [1e-5 * 2 ** (i / 2) for i in range(44)] # границы корзин гистограммы задержек, с: от 10 мкс до ~40 с
+
+class Session: # состояние подключения клиента
+    def __init__(self, connection, addr):
+        self.connection = connection
+        self.addr = addr
+        self.encoding = "json" # формат ответов UPDATE, меняется командой HELLO
+        self.framed = None # команды с размером в первых 4 байтах; определяется по первому чтению
+        self.buffer = bytearray() # начало недочитанной команды
+        self.send_lock = threading.Lock() # ответы на команды и события WATCH не перемешиваются
+        self.events = queue.Queue(maxsize=WATCH_QUEUE_SIZE) # события WATCH, ожидающие отправки
+
+class ScanCache:
+    def __init__(self, on_change=None):
+        self.on_change = on_change # вызывается с директорией, если при пересканировании изменился список файлов
+        self.entries = {} # директория -> (версия директории, список исполняемых файлов)
+        self.indexes = {} # (директория, поле) -> (версия директории, файлы, отсортированные по полю)
+        self.generation = 0 # счетчик принудительных пересканирований, изменивших файлы при том же mtime директории
+        self.hits = 0
+        self.misses = 0
+        self.durations = {} # директория -> время последнего полного сканирования, с
+        self.lock = threading.Lock() # сканирование идет из нескольких потоков сервера
+        if hasattr(os, "geteuid"): # uid и группы процесса запрашиваем один раз, а не для каждого файла
+            self.uid = os.geteuid()
+            self.gids = {os.getegid(), *os.getgroups()}
+        else:
+            self.uid = None
+
+    def is_executable(self, entry, st): # проверка прав на исполнение по уже полученному stat, без лишнего вызова os.access
+        if self.uid is None: # на Windows нет uid/gid, используем os.access
+            return os.access(entry.path, os.X_OK)
+        if self.uid == 0:
+            return bool(st.st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+        if st.st_uid == self.uid:
+            return bool(st.st_mode & stat.S_IXUSR)
+        if st.st_gid in self.gids:
+            return bool(st.st_mode & stat.S_IXGRP)
+        return bool(st.st_mode & stat.S_IXOTH)
+
+    def scan_directory(self, directory): # один проход os.scandir с переиспользованием stat из DirEntry
+        exec_files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file(): # для обычных файлов тип берется из d_type без вызова stat
+                        continue
+                    st = entry.stat() # stat кешируется в DirEntry
+                except OSError: # файл мог быть удален во время обхода
+                    continue
+                if self.is_executable(entry, st):
+                    exec_files.append({"name": entry.name,
+                        "size": st.st_size,
+                        "mtime": st.st_mtime})
+        return exec_files
+
+    def scan_entry(self, directory, force=False): # (версия директории, исполняемые файлы), пересканирование только при изменении mtime директории
+        # mtime директории меняется при создании, удалении и переименовании файлов (так обновляют бинарники менеджеры пакетов);
+        # force - пересканировать, даже если mtime тот же (inotify сообщил об изменении самого файла)
+        # версия - (mtime директории в нс, поколение): поколение растет, когда force нашел изменения при том же mtime
+        dir_mtime = os.stat(directory).st_mtime_ns
+        cached = self.entries.get(directory)
+        if cached is not None and cached[0][0] == dir_mtime and not force:
+            with self.lock:
+                self.hits += 1
+            return cached
+        start = time.perf_counter()
+        exec_files = self.scan_directory(directory)
+        changed = cached is not None and cached[1] != exec_files
+        with self.lock:
+            self.durations[directory] = time.perf_counter() - start
+            self.misses += 1
+            generation = cached[0][1] if cached is not None else 0
+            if changed and cached[0][0] == dir_mtime: # файлы изменились на месте: индексы и версии по mtime устарели
+                self.generation += 1
+                generation = self.generation
+                for sort in SORT_KEYS:
+                    self.indexes.pop((directory, sort), None)
+            version = (dir_mtime, generation)
+            self.entries[directory] = (version, exec_files)
+        if changed and self.on_change is not None:
+            self.on_change(directory)
+        return version, exec_files
+
+    def sorted_files(self, directory, version, exec_files, sort): # отсортированный индекс строится один раз на версию директории
+        index = self.indexes.get((directory, sort))
+        if index is not None and index[0] == version:
+            return index[1]
+        sorted_files = sorted(exec_files, key=lambda x: x[sort]) # сортируем копию, чтобы не менять кеш
+        self.indexes[(directory, sort)] = (version, sorted_files)
+        return sorted_files
+
+    def stats(self): # счетчики попаданий и промахов кеша
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "directories": len(self.entries)}
+
+class ScanTask: # сканирование директории в пуле; срок ожидания результата отсчитывается от начала сканирования, а не от очереди
+    def __init__(self, scan_cache, directory):
+        self.scan_cache = scan_cache
+        self.directory = directory
+        self.started = threading.Event()
+        self.start_time = None
+
+    def __call__(self):
+        self.start_time = time.monotonic()
+        self.started.set()
+        return self.scan_cache.scan_entry(self.directory)
+
+class HistoryStore:
+    def __init__(self, path="history_environment.log", legacy_path="history_environment.json",
+                 keep_per_key=100, compact_every=1000, index_every=100):
+        self.path = path # журнал: по одной JSON-записи на строку, только дозапись в конец
+        self.index_path = os.path.splitext(path)[0] + ".idx" # индекс: ключ -> смещение последней записи ключа
+        self.keep_per_key = keep_per_key # сколько последних записей ключа остается после сжатия
+        self.compact_every = compact_every # сжатие, когда накопилось столько лишних записей
+        self.index_every = index_every # индекс сохраняется раз в index_every дозаписей, хвост журнала дочитывается при запуске
+        self.lock = threading.Lock()
+        self.load_index()
+        if self.size == 0 and os.path.exists(legacy_path): # однократный перенос истории из старого JSON-файла
+            self.import_legacy(legacy_path)
+
+    def load_index(self): # загрузка индекса и дочитывание записей, добавленных после его сохранения
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self.keys = index["keys"] # ключ -> [смещение последней записи, число записей ключа в журнале]
+            self.size = index["size"]
+            inode = index["inode"] # файл журнала, по которому построен индекс
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            self.keys, self.size, inode = {}, 0, None
+        self.pending = 0
+        with open(self.path, 'ab+') as f:
+            st = os.fstat(f.fileno())
+            self.inode = st.st_ino
+            # индекс другого файла (сбой между заменой журнала при сжатии и записью индекса) или длиннее журнала -
+            # его смещения ничего не значат, индекс строится заново с начала журнала
+            if inode != self.inode or st.st_size < self.size:
+                self.keys, self.size = {}, 0
+            f.seek(self.size)
+            for line in f:
+                if not line.endswith(b"\n"): # недописанная при сбое строка
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self.index_record(record["key"], self.size)
+                self.size += len(line)
+                self.pending += 1
+            f.truncate(self.size) # отрезаем поврежденный хвост, чтобы новые записи начинались с новой строки
+        self.garbage = sum(max(0, count - self.keep_per_key) for _, count in self.keys.values())
+        self.log = open(self.path, 'ab')
+
+    def index_record(self, key, offset):
+        _, count = self.keys.get(key, (None, 0))
+        self.keys[key] = [offset, count + 1]
+
+    def save_index(self): # атомарная запись индекса через временный файл
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"inode": self.inode, "size": self.size, "keys": self.keys}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        self.pending = 0
+
+    def import_legacy(self, legacy_path):
+        try:
+            with open(legacy_path, 'r') as f:
+                records = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        self.append([(r["key"], r["value"]) for r in records], [r.get("timestamp") for r in records])
+        logging.info(f"История перенесена из {legacy_path}: {len(records)} записей")
+
+    def append(self, changes, timestamps=None): # дозапись изменений одной операцией записи с fsync
+        now = datetime.now().isoformat()
+        with self.lock:
+            chunk = bytearray()
+            for i, (key, val) in enumerate(changes):
+                prev = self.keys[key][0] if key in self.keys else None # ссылка на предыдущую запись того же ключа
+                line = json.dumps({"timestamp": (timestamps[i] if timestamps else None) or now,
+                                   "key": key, "value": val, "prev": prev}, ensure_ascii=False).encode() + b"\n"
+                self.index_record(key, self.size + len(chunk))
+                if self.keys[key][1] > self.keep_per_key:
+                    self.garbage += 1
+                chunk += line
+            self.log.write(chunk)
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.size += len(chunk)
+            self.pending += len(changes)
+            if self.garbage >= self.compact_every:
+                self.compact()
+            elif self.pending >= self.index_every:
+                self.save_index()
+
+    def read_chain(self, f, key, limit): # (смещение, запись) последних записей ключа по цепочке ссылок prev, от новых к старым
+        records = []
+        offset = self.keys[key][0] if key in self.keys else None
+        while offset is not None and len(records) < limit:
+            f.seek(offset)
+            record = json.loads(f.readline())
+            records.append((offset, record))
+            offset = record.pop("prev")
+        return records
+
+    def get(self, key, limit=10): # последние изменения ключа без чтения всего журнала
+        with self.lock, open(self.path, 'rb') as f:
+            return [record for _, record in self.read_chain(f, key, limit)]
+
+    def compact(self): # перезапись журнала с последними keep_per_key записями каждого ключа
+        with open(self.path, 'rb') as f:
+            kept = []
+            for key in self.keys:
+                kept.extend(self.read_chain(f, key, self.keep_per_key))
+        kept.sort(key=lambda item: item[0]) # сохраняем порядок записей в журнале, в том числе с одинаковым временем
+        tmp_path = self.path + ".tmp"
+        keys, size = {}, 0
+        with open(tmp_path, 'wb') as f:
+            for _, record in kept:
+                key = record["key"]
+                record["prev"] = keys[key][0] if key in keys else None
+                line = json.dumps(record, ensure_ascii=False).encode() + b"\n"
+                keys[key] = [size, keys[key][1] + 1 if key in keys else 1]
+                f.write(line)
+                size += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+            inode = os.fstat(f.fileno()).st_ino
+        self.log.close()
+        os.replace(tmp_path, self.path)
+        self.log = open(self.path, 'ab')
+        self.keys, self.size, self.garbage, self.inode = keys, size, 0, inode
+        self.save_index()
+        logging.info(f"История сжата: {len(kept)} записей, {size} байт")
+
+class Inotify: # минимальная обертка над inotify Linux через ctypes
+    IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF, IN_IGNORED = 0x100, 0x200, 0x400, 0x800, 0x8000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True) # AttributeError, если inotify нет
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.watches = {} # дескриптор наблюдения -> директория
+
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {directory}")
+        self.watches[wd] = directory
+
+    def read(self): # директории, в которых произошли события
+        directories = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return directories
+        offset = 0
+        while offset < len(data): # struct inotify_event: wd, mask, cookie, len, затем имя длины len
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            offset += 16 + length
+            if wd in self.watches:
+                directories.add(self.watches[wd])
+            if mask & self.IN_IGNORED: # наблюдение снято (директория удалена)
+                self.watches.pop(wd, None)
+        return directories
+
+class PathWatcher: # события об изменениях исполняемых файлов PATH и переменных для подписчиков WATCH
+    def __init__(self, server, interval=1.0):
+        self.server = server
+        self.interval = interval # период опроса без inotify и проверки новых директорий PATH
+        self.subscribers = set()
+        self.published = {} # директория -> (mtime директории, список файлов), о котором подписчики уже знают
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, session):
+        with self.lock:
+            self.subscribers.add(session)
+            if self.thread is None: # наблюдение запускается при первой подписке
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, session):
+        with self.lock:
+            self.subscribers.discard(session)
+
+    def publish(self, event): # событие всем подписчикам; отключившиеся и отставшие удаляются
+        with self.lock:
+            subscribers = list(self.subscribers)
+        data = json.dumps(event).encode()
+        for session in subscribers:
+            try:
+                session.events.put_nowait(data)
+                self.server.flush_events(session)
+            except (queue.Full, OSError) as e: # подписчик не читает события: не копим их и не ждем его
+                self.drop(session, e)
+
+    def drop(self, session, reason):
+        # отписка и разрыв соединения; закрывает сокет поток, обслуживающий команды клиента, когда увидит разрыв
+        self.unsubscribe(session)
+        logging.warning(f"Подписчик {session.addr} отключен: {reason or 'очередь событий переполнена'}")
+        try:
+            session.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def path(self):
+        return [d for d in dict.fromkeys(os.environ.get("PATH", "").split(os.pathsep)) if d]
+
+    def run(self):
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError, TypeError) as e: # не Linux или inotify недоступен - периодическое инкрементальное сканирование
+            logging.info(f"inotify недоступен ({e}), изменения PATH отслеживаются опросом")
+            inotify = None
+        for directory in self.path(): # исходное состояние, с которым сравниваются изменения
+            self.rescan(directory, publish=False)
+        while True:
+            try:
+                for directory in self.poll(inotify):
+                    self.rescan(directory)
+            except Exception as e:
+                logging.error(f"Ошибка наблюдения за PATH: {e}")
+                time.sleep(self.interval)
+
+    def poll(self, inotify): # директории, которые нужно пересканировать
+        path = self.path()
+        if inotify is None:
+            time.sleep(self.interval)
+            dirty = []
+            for directory in path:
+                published = self.published.get(directory) # кеш сканирования обновляют и запросы UPDATE, сравниваем со своим списком
+                try:
+                    changed = published is None or os.stat(directory).st_mtime_ns != published[0]
+                except OSError:
+                    changed = published is not None
+                if changed:
+                    dirty.append(directory)
+            return dirty
+        watched = set(inotify.watches.values())
+        for directory in path:
+            if directory not in watched:
+                try:
+                    inotify.add(directory)
+                    self.rescan(directory, publish=False)
+                except OSError: # директории пока нет, попробуем на следующем круге
+                    pass
+        ready, _, _ = select.select([inotify.fd], [], [], self.interval)
+        if not ready:
+            return []
+        time.sleep(WATCH_DEBOUNCE) # пачка событий (например, установка пакета) обрабатывается одним пересканированием
+        changed = inotify.read()
+        return [d for d in path if d in changed]
+
+    def rescan(self, directory, publish=True): # пересканирование директории и события о разнице со старым списком
+        old = self.published.get(directory)
+        try:
+            version, exec_files = self.server.scan_cache.scan_entry(directory, force=True)
+            self.published[directory] = (version[0], exec_files)
+        except OSError: # директорию удалили
+            exec_files = []
+            self.server.scan_cache.entries.pop(directory, None)
+            self.published.pop(directory, None)
+        if not publish or old is None:
+            return
+        old_files = {f["name"]: f for f in old[1]}
+        new_files = {f["name"]: f for f in exec_files}
+        for name, f in new_files.items():
+            if name not in old_files:
+                self.publish({"event": "added", "directory": directory, **f})
+            elif old_files[name] != f:
+                self.publish({"event": "modified", "directory": directory, **f})
+        for name, f in old_files.items():
+            if name not in new_files:
+                self.publish({"event": "removed", "directory": directory, **f})
+
+class ResponseCache: # готовые кадры ответов UPDATE по запросу и формату: повторный UPDATE - один sendall
+    def __init__(self, max_bytes=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_entry = max_bytes // 4 # один большой ответ не вытесняет весь кеш
+        self.ttl = ttl # изменения, о которых сервер не узнал (нет WATCH и сканирования), видны не позже чем через ttl
+        self.entries = OrderedDict() # ключ -> (время создания, кадры), от давно использованных к недавним
+        self.size = 0
+        self.generation = 0 # номер сброса: ответ, собранный до SET или изменения PATH, не сохраняется
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, data, generation):
+        if len(data) > self.max_entry:
+            return
+        with self.lock:
+            if generation != self.generation: # пока ответ собирался, кеш сбросили
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (time.monotonic(), data)
+            self.size += len(data)
+            while self.size > self.max_bytes: # вытеснение давно использованных ответов
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self, *args): # сброс после SET, MSET или изменения директории PATH
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+class ServerStats: # счетчики для команды STATS: обновление - несколько операций под блокировкой
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {} # команда -> гистограмма задержек по LATENCY_BUCKETS, последняя корзина - больше всех границ
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connections = 0 # открытые соединения
+        self.connections_total = 0
+        self.lock = threading.Lock()
+
+    def record(self, command, seconds): # выполненная команда и ее задержка
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = self.commands[command] = [0] * (len(LATENCY_BUCKETS) + 1)
+            histogram[bucket] += 1
+
+    def add_traffic(self, sent=0, received=0):
+        with self.lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def add_connection(self, delta):
+        with self.lock:
+            self.connections += delta
+            if delta > 0:
+                self.connections_total += delta
+
+    def percentile(self, histogram, q): # верхняя граница корзины, в которую попал q-й перцентиль, мс
+        rank = q * sum(histogram)
+        cumulative = 0
+        for bucket, count in enumerate(histogram):
+            cumulative += count
+            if count and cumulative >= rank:
+                return round(LATENCY_BUCKETS[min(bucket, len(LATENCY_BUCKETS) - 1)] * 1000, 3)
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            commands = {name: list(histogram) for name, histogram in self.commands.items()}
+            stats = {"uptime": round(time.time() - self.started, 3),
+                     "connections": self.connections, "connections_total": self.connections_total,
+                     "bytes_sent": self.bytes_sent, "bytes_received": self.bytes_received}
+        stats["commands"] = {name: {"count": sum(histogram),
+                                    "p50_ms": self.percentile(histogram, 0.5),
+                                    "p95_ms": self.percentile(histogram, 0.95),
+                                    "p99_ms": self.percentile(histogram, 0.99)}
+                             for name, histogram in commands.items()}
+        return stats
 
 class Server:
-    def __init__(self, host='127.0.0.1', port=57535):
+    def __init__(self, host='127.0.0.1', port=57535, backlog=64, workers=8, concurrent=True, save_snapshot=False,
+                 response_cache_size=RESPONSE_CACHE_SIZE, response_cache_ttl=RESPONSE_CACHE_TTL, stats_interval=None,
+                 scan_workers=8, scan_timeout=2.0):
         self.my_host = host 
         self.my_port = port  
+        self.save_snapshot = save_snapshot # дублировать ли отправленный снимок в data_environment.json
+        self.workers = workers # размер пула потоков, выполняющих команды
+        self.concurrent = concurrent # False - старый режим: один клиент за раз
+        self.lock = threading.Lock() # защита os.environ и файла истории от одновременных SET
         self.socket_serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # создание сокета для сетевого взаимодействия 
+        self.socket_serv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket_serv.bind((self.my_host, self.my_port)) # привязка сокета к IP-адресу и порту
-        self.socket_serv.listen(1) # максимум 1 подключение в очереди
+        self.socket_serv.listen(backlog) # максимальная очередь ожидающих подключений
         self.data_file = "data_environment.json"
-        self.history_file = "history_environment.json"
-        logging.basicConfig(filename='server.log', level=logging.INFO, # настройка логирования: запись в файл server.log, уровень INFO, формат с временем
-                            format='%(asctime)s - %(message)s')
+        self.history_file = "history_environment.log"
+        self.response_cache = ResponseCache(response_cache_size, response_cache_ttl)
+        self.scan_cache = ScanCache(on_change=self.response_cache.clear) # кеш сканирования директорий PATH между запросами UPDATE
+        self.scan_pool = ThreadPoolExecutor(max_workers=scan_workers) # параллельное сканирование директорий PATH
+        self.scan_timeout = scan_timeout # сколько секунд UPDATE ждет сканирования одной директории с его начала
+        self.scan_futures = {} # директория -> (ScanTask, future) текущего сканирования
+        self.scan_lock = threading.Lock()
+        self.watcher = PathWatcher(self)
+        self.versions = OrderedDict() # версия -> переменные и mtime директорий, для ответов UPDATE SINCE
+        self.version = 0
+        self.versions_lock = threading.Lock()
+        # логирование через очередь: запись в server.log идет в отдельном потоке, задержки диска не тормозят команды
+        log_queue = queue.SimpleQueue()
+        file_handler = logging.FileHandler('server.log')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s')) # время берется из записи, а не из момента записи в файл
+        self.log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self.log_listener.start()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.setFormatter(logging.Formatter('%(message)s')) # в очередь уходит только текст, время добавит file_handler
+        logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+        self.stats = ServerStats()
+        if stats_interval: # периодическая запись статистики в журнал
+            threading.Thread(target=self.dump_stats, args=(stats_interval,), daemon=True).start()
         logging.info("Сервер запущен")
         print(f"Сервер запущен на {self.my_host}:{self.my_port}")  
         self.load_history()  
 
-    def load_history(self):     # загрузка истории изменений переменных из файла
-        try:
-            with open(self.history_file, 'r') as f:
-                self.history = json.load(f)  
-        except (FileNotFoundError, json.JSONDecodeError): 
-            self.history = [] # пустой список, если нет данных
-
-    def save_changes(self, key, val): # сохранение новой записи в историю изменений переменных окружения
-        self.history.append({"timestamp": datetime.now().isoformat(),   
-            "key": key, 
-            "value": val})
-        with open(self.history_file, 'w') as f:
-            json.dump(self.history, f, indent=4) # сохранение в файл в формате JSON 
-
-    def get_environment_data(self, sort=None): # сбор данных об окружении
+    def load_history(self):     # открытие журнала истории изменений переменных, без чтения всего файла
+        self.history = HistoryStore(self.history_file)
+
+    def save_changes(self, key, val): # дозапись новой записи в историю изменений переменных окружения
+        self.history.append([(key, val)])
+
+    def get_variables(self): # снимок переменных окружения без гонки с SET
+        with self.lock:
+            return dict(os.environ)
+
+    def get_stats(self): # данные команды STATS
+        stats = self.stats.snapshot()
+        stats["scan_cache"] = self.scan_cache.stats()
+        stats["response_cache"] = self.response_cache.stats()
+        stats["scan_ms"] = {d: round(seconds * 1000, 3) for d, seconds in list(self.scan_cache.durations.items())}
+        return stats
+
+    def dump_stats(self, interval):
+        while True:
+            time.sleep(interval)
+            logging.info(f"Статистика: {json.dumps(self.get_stats())}")
+
+    def submit_scan(self, directory): # сканирование директории в пуле; незавершенное сканирование медленной директории переиспользуется
+        with self.scan_lock:
+            scan = self.scan_futures.get(directory)
+            if scan is None or scan[1].done():
+                task = ScanTask(self.scan_cache, directory)
+                scan = (task, self.scan_pool.submit(task))
+                self.scan_futures[directory] = scan
+            return scan
+
+    def collect_directories(self): # (директория, версия, исполняемые файлы) в порядке PATH и список директорий, не успевших за scan_timeout
         path = os.environ.get("PATH", "").split(os.pathsep)    # получение списка директорий из переменной окружения PATH
-        environment_data = {"directories": {}, "variables": dict(os.environ)} 
-        for directory in path:
-            if os.path.isdir(directory): # проверяем является ли путь директорией
-                try:
-                    files = os.listdir(directory)    # получаем список файлов в директории
-                    exec_files = [{"name": f,  
-                         "size": os.path.getsize(os.path.join(directory, f)), 
-                         "mtime": os.path.getmtime(os.path.join(directory, f))}  
-                        for f in files 
-                        if os.path.isfile(os.path.join(directory, f))  # проверка, что это файл
-                        and os.access(os.path.join(directory, f), os.X_OK)]  # проверка, что файл исполняемый
-                    if sort: 
-                        if sort == "name":
-                            exec_files.sort(key=lambda x: x["name"])
-                        elif sort == "size":
-                            exec_files.sort(key=lambda x: x["size"])
-                        elif sort == "mtime":
-                            exec_files.sort(key=lambda x: x["mtime"])
-                    if exec_files: # если есть исполняемые файлы, добавление их в словарь данных
-                        environment_data["directories"][directory] = exec_files
-                except PermissionError:     # пропуск директории, если нет прав доступа
+        path = [d for d in dict.fromkeys(path) if d] # пустые и повторяющиеся записи PATH пропускаем
+        scans = [(directory, *self.submit_scan(directory)) for directory in path] # директории сканируются параллельно
+        # у каждой директории scan_timeout с начала ее сканирования; дольше scan_timeout директория ждет только
+        # свободного потока пула, когда все потоки заняты медленными директориями
+        queue_deadline = time.monotonic() + self.scan_timeout
+        directories, timed_out = [], []
+        for directory, task, future in scans: # результаты собираются в порядке PATH
+            try:
+                if not task.started.wait(max(0, queue_deadline - time.monotonic())):
+                    raise FutureTimeoutError()
+                version, exec_files = future.result(timeout=max(0, task.start_time + self.scan_timeout - time.monotonic()))
+            except FutureTimeoutError: # медленная директория (например, NFS) не задерживает весь ответ
+                timed_out.append(directory)
+                cached = self.scan_cache.entries.get(directory) # прошлый результат лучше, чем никакого
+                if cached is None:
                     continue
-        return environment_data
-    
-    def save_to_file(self, data): # сохранение данных в файл
-        with open(self.data_file, 'w') as f:
-            json.dump(data, f, indent=4)  
+                version, exec_files = cached
+            except OSError: # пропуск, если это не директория, ее нет или нет прав доступа
+                continue
+            if exec_files: # директории без исполняемых файлов в ответ не попадают
+                directories.append((directory, version, exec_files))
+        if timed_out:
+            logging.warning(f"Истекло время сканирования директорий: {timed_out}")
+        return directories, timed_out
 
-    def send_file(self, connection):  # отправка файла клиенту
-        try:
-            with open(self.data_file, 'rb') as f:
-                data = f.read() 
-                connection.send(struct.pack('!I', len(data))) # упаковка размера данных в 4 байта 
-                connection.send(data) # отправка данных клиенту
-        except Exception as e: 
-            logging.error(f"Ошибка при отправке файла: {e}")
+    def select_files(self, directory, version, exec_files, query): # файлы директории в порядке и с фильтром запроса
+        if query["sort"]:
+            exec_files = self.scan_cache.sorted_files(directory, version, exec_files, query["sort"])
+            if query["desc"]:
+                exec_files = exec_files[::-1]
+        if query["match"]:
+            exec_files = [f for f in exec_files if fnmatch.fnmatchcase(f["name"], query["match"])]
+        return exec_files
+
+    def top_files(self, directories, query): # первые limit файлов по всем директориям: слияние отсортированных индексов через кучу
+        sort, desc, match = query["sort"], query["desc"], query["match"]
+        def ranked(directory, version, exec_files):
+            index = self.scan_cache.sorted_files(directory, version, exec_files, sort)
+            for f in (reversed(index) if desc else index):
+                if match is None or fnmatch.fnmatchcase(f["name"], match):
+                    yield directory, f
+        merged = heapq.merge(*(ranked(*item) for item in directories), key=lambda item: item[1][sort], reverse=desc)
+        return [{"directory": directory, **f} for directory, f in itertools.islice(merged, query["limit"])]
+
+    def register_version(self, variables, directories, since=None): # номер версии текущего состояния и состояние версии since
+        state = {"variables": variables, "directories": {d: version for d, version, _ in directories}}
+        with self.versions_lock:
+            if not self.versions or self.versions[self.version] != state: # состояние изменилось - новая версия
+                self.version += 1
+                self.versions[self.version] = state
+                if len(self.versions) > MAX_VERSIONS:
+                    self.versions.popitem(last=False)
+            return self.version, self.versions.get(since)
+
+    def encode_list(self, values): # JSON-массив порциями: большие директории не кодируются целиком
+        yield b"["
+        for i in range(0, len(values), FILES_PER_PIECE):
+            piece = json.dumps(values[i:i + FILES_PER_PIECE], separators=(",", ":"))[1:-1]
+            yield (b"," if i else b"") + piece.encode()
+        yield b"]"
+
+    def encode_directories(self, directories, query, encoding="json", keep_empty=False): # JSON-объект директорий по частям
+        yield b"{"
+        first = True
+        for directory, version, exec_files in directories:
+            exec_files = self.select_files(directory, version, exec_files, query)
+            if not exec_files and not keep_empty: # ни один файл директории не прошел фильтр MATCH
+                continue
+            yield (b"" if first else b",") + json.dumps(directory).encode() + b":"
+            first = False
+            if encoding.startswith("columnar"): # по массиву на поле вместо повторения ключей в каждом файле
+                for i, column in enumerate(("name", "size", "mtime")):
+                    yield (b"," if i else b"{") + f'"{column}":'.encode()
+                    yield from self.encode_list([f[column] for f in exec_files])
+                yield b"}"
+            else:
+                yield from self.encode_list(exec_files)
+        yield b"}"
+
+    def compress(self, pieces): # сжатие потока частей zlib без сборки всего ответа
+        compressor = zlib.compressobj(ZLIB_LEVEL)
+        for piece in pieces:
+            compressed = compressor.compress(piece)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def encode_snapshot(self, query, encoding="json", meta=None): # снимок или изменения с версии since в формате encoding
+        pieces = self.encode_snapshot_json(query, encoding, meta)
+        return self.compress(pieces) if encoding.endswith("+zlib") else pieces
+
+    def encode_snapshot_json(self, query, encoding="json", meta=None): # JSON снимка или изменений по частям; в meta - timed_out
+        variables = self.get_variables()
+        directories, timed_out = self.collect_directories()
+        if meta is not None:
+            meta["timed_out"] = timed_out
+        since = query["since"] if query["limit"] is None else None
+        version, base = self.register_version(variables, directories, since)
+        if query["limit"] is not None: # только первые limit файлов по всем директориям, без переменных
+            top = {"version": version, "files": self.top_files(directories, query)}
+            if timed_out:
+                top["timed_out"] = timed_out
+            yield json.dumps(top, separators=(",", ":")).encode()
+            return
+        if base is None: # версия since неизвестна или не запрошена - полный снимок
+            yield b'{"version":' + str(version).encode()
+            if timed_out: # директории, для которых отданы прошлые данные или нет данных
+                yield b',"timed_out":' + json.dumps(timed_out).encode()
+            yield b',"directories":'
+            yield from self.encode_directories(directories, query, encoding)
+            yield b',"variables":' + json.dumps(variables, separators=(",", ":")).encode() + b"}"
+            return
+        order = [d for d, _, _ in directories] # порядок директорий в PATH
+        delta = {"version": version, "since": since, "delta": True,
+                 "variables": {"set": {k: v for k, v in variables.items() if base["variables"].get(k) != v},
+                               "removed": [k for k in base["variables"] if k not in variables]},
+                 "order": order,
+                 "timed_out": timed_out,
+                 "removed_directories": [d for d in base["directories"] if d not in set(order)]}
+        yield json.dumps(delta, separators=(",", ":")).encode()[:-1] + b',"directories":'
+        changed = [item for item in directories if base["directories"].get(item[0]) != item[1]]
+        yield from self.encode_directories(changed, query, encoding, keep_empty=True)
+        yield b"}"
+
+    def send_snapshot(self, session, query): # потоковая отправка снимка, при save_snapshot копия полного снимка пишется в файл
+        connection = session.connection
+        if not session.framed: # старым клиентам - весь ответ одним блоком с размером, как до перехода на кадры
+            data = b"".join(self.encode_snapshot(query, session.encoding))
+            self.send_data(session, data)
+            return
+        # ответ на SINCE зависит от версии клиента, его не кешируем
+        key = None if query["since"] is not None else (query["sort"], query["desc"], query["match"], query["limit"], session.encoding)
+        if key is not None:
+            data = self.response_cache.get(key)
+            if data is not None: # готовые кадры: без сканирования, сортировки и кодирования
+                connection.sendall(data)
+                self.stats.add_traffic(sent=len(data))
+                return
+        generation = self.response_cache.generation
+        full = query["since"] is None and query["limit"] is None and query["match"] is None
+        save = self.save_snapshot and full and session.encoding == "json"
+        tmp_path = f"{self.data_file}.{threading.get_ident()}.tmp" # у каждого потока свой временный файл
+        meta = {}
+        frames, size = [], 0
+        with open(tmp_path, 'wb') if save else contextlib.nullcontext() as f:
+            for frame in self.iter_frames(self.encode_snapshot(query, session.encoding, meta), f):
+                connection.sendall(frame)
+                size += len(frame)
+                if key is not None: # кадры копятся для кеша, пока ответ не больше max_entry
+                    if size > self.response_cache.max_entry:
+                        key, frames = None, None
+                    else:
+                        frames.append(frame)
+        self.stats.add_traffic(sent=size)
+        if save:
+            os.replace(tmp_path, self.data_file)
+        if key is not None and not meta["timed_out"]: # ответ с устаревшими данными медленных директорий не кешируем
+            self.response_cache.put(key, b"".join(frames), generation)
+
+    def iter_frames(self, pieces, copy_to=None): # части ответа кадрами до CHUNK_SIZE, в конце пустой кадр
+        buffer = bytearray()
+        for piece in pieces:
+            buffer += piece
+            if len(buffer) >= CHUNK_SIZE: # кадр: размер в первых 4 байтах, затем данные
+                if copy_to is not None:
+                    copy_to.write(buffer)
+                yield struct.pack('!I', len(buffer)) + buffer
+                buffer.clear()
+        if copy_to is not None and buffer:
+            copy_to.write(buffer)
+        # последний кадр уходит вместе с пустым, чтобы маленький хвост ответа не ждал подтверждения (алгоритм Нейгла)
+        yield (struct.pack('!I', len(buffer)) + buffer if buffer else b"") + struct.pack('!I', 0)
+
+    def send_stream(self, connection, pieces, copy_to=None): # отправка частей кадрами
+        sent = 0
+        for frame in self.iter_frames(pieces, copy_to):
+            connection.sendall(frame)
+            sent += len(frame)
+        self.stats.add_traffic(sent=sent)
+
+    def pack_data(self, session, data): # готовые данные тем же потоком кадров
+        if not session.framed: # старые клиенты: одним блоком с размером в первых 4 байтах, без кадров
+            return struct.pack('!I', len(data)) + data
+        return b"".join(self.iter_frames([data]))
+
+    def send_data(self, session, data):
+        data = self.pack_data(session, data)
+        session.connection.sendall(data)
+        self.stats.add_traffic(sent=len(data))
+
+    def send_event(self, session, data): # событие WATCH без блокировки потока: если не ушло за WATCH_SEND_TIMEOUT - TimeoutError
+        view = memoryview(self.pack_data(session, data))
+        deadline = time.monotonic() + WATCH_SEND_TIMEOUT
+        while view:
+            try:
+                sent = session.connection.send(view, MSG_DONTWAIT)
+            except BlockingIOError: # буфер сокета полон: ждем, пока клиент прочитает, но не дольше срока
+                with selectors.DefaultSelector() as selector:
+                    selector.register(session.connection, selectors.EVENT_WRITE)
+                    if not selector.select(max(0, deadline - time.monotonic())):
+                        raise TimeoutError(f"клиент не читает события {WATCH_SEND_TIMEOUT} с")
+                continue
+            view = view[sent:]
+            self.stats.add_traffic(sent=sent)
 
     def make_hash(self, data):     # создание хеша из строки данных для проверки целостности данных
         return hashlib.sha256(data.encode()).hexdigest() 
 
+    def reply(self, session, text): # текстовый ответ: в режиме кадров - кадром, как и данные UPDATE
+        if session.framed:
+            self.send_data(session, text.encode())
+        else:
+            session.connection.send(text.encode())
+
+    def handle_command(self, session, command): # обработка одной команды клиента
+        addr = session.addr
+        logging.info(f"Получена команда: {command}")
+        if command.startswith("UPDATE"):
+            try:
+                query = self.parse_update(command)
+            except ValueError:
+                self.reply(session, "ERROR: Invalid sort criterion")
+                return
+            self.send_snapshot(session, query)
+            logging.info(f"Данные обновлены и отправлены, кеш сканирования: {self.scan_cache.stats()}, "
+                         f"кеш ответов: {self.response_cache.stats()}")
+    
+        elif command.startswith("SET "): 
+            try:
+                _, key, val, client_hash = command.split(" ", 3) # разделение команды на части: SET, ключ, значение, хеш     
+                expected_hash = self.make_hash(f"SET {key} {val}") # вычисление ожидаемого хеша для проверки
+                if client_hash != expected_hash:  # проверка совпадения хеша от клиента с ожидаемым 
+                    self.reply(session, "ERROR: Hash mismatch")
+                    logging.warning(f"Ошибка хеша для команды SET от {addr}")
+                    return
+                with self.lock: # переменная и запись в историю меняются вместе, без гонки с другими клиентами
+                    os.environ[key] = val # установка переменной окружения
+                    self.save_changes(key, val) # сохранение изменения в историю
+                self.response_cache.clear()
+                self.reply(session, "OK")
+                self.watcher.publish({"event": "set", "key": key, "value": val})
+                logging.info(f"Установлена переменная: {key} = {val}")
+            except ValueError:  
+                self.reply(session, "ERROR: Invalid SET command")
+        
+        elif command.startswith("MSET"): # пакетная установка: строки "<ключ> <значение> <хеш>" после MSET
+            try:
+                changes = []
+                for line in command.split("\n")[1:]:
+                    key, rest = line.split(" ", 1)
+                    val, client_hash = rest.rsplit(" ", 1)
+                    if client_hash != self.make_hash(f"SET {key} {val}"): # каждое присваивание проверяется как SET
+                        self.reply(session, f"ERROR: Hash mismatch for {key}")
+                        logging.warning(f"Ошибка хеша для команды MSET от {addr}")
+                        return
+                    changes.append((key, val))
+            except ValueError:
+                self.reply(session, "ERROR: Invalid MSET command")
+                return
+            with self.lock: # весь пакет применяется целиком и одной дозаписью в историю
+                for key, val in changes:
+                    os.environ[key] = val
+                self.history.append(changes)
+            self.response_cache.clear()
+            self.reply(session, f"OK {len(changes)}")
+            for key, val in changes:
+                self.watcher.publish({"event": "set", "key": key, "value": val})
+            logging.info(f"Установлено переменных: {len(changes)}")
+
+        elif command == "WATCH": # после OK сервер присылает события кадрами, пока клиент не отправит UNWATCH
+            self.reply(session, "OK")
+            self.watcher.subscribe(session)
+            logging.info(f"Клиент подписался на события: {addr}")
+
+        elif command == "UNWATCH":
+            self.watcher.unsubscribe(session)
+            self.reply(session, "OK")
+
+        elif command.startswith("VARS"): # переменные окружения с заданным префиксом
+            prefix = command[len("VARS"):].strip()
+            variables = {k: v for k, v in self.get_variables().items() if k.startswith(prefix)}
+            self.send_data(session, json.dumps({"variables": variables}).encode())
+            logging.info(f"Отправлены переменные с префиксом '{prefix}': {len(variables)}")
+
+        elif command.startswith("HISTORY "):
+            history_parts = command.split()
+            limit = 10 # по умолчанию последние 10 изменений
+            if len(history_parts) == 4 and history_parts[2] == "LIMIT" and history_parts[3].isdigit():
+                limit = int(history_parts[3])
+            elif len(history_parts) != 2:
+                self.reply(session, "ERROR: Invalid HISTORY command")
+                return
+            records = self.history.get(history_parts[1], limit)
+            self.send_data(session, json.dumps(records).encode())
+            logging.info(f"Отправлена история {history_parts[1]}: {len(records)} записей")
+
+        elif command == "STATS": # счетчики и перцентили задержек команд, трафик, время сканирования директорий
+            self.send_data(session, json.dumps(self.get_stats()).encode())
+
+        elif command.startswith("HELLO"): # согласование формата ответов UPDATE: клиент перечисляет форматы по предпочтению
+            offered = command.split()[1:]
+            session.encoding = next((e for e in offered if e in ENCODINGS), "json")
+            self.reply(session, f"OK {session.encoding}")
+            logging.info(f"Формат ответов для {addr}: {session.encoding}")
+
+        else: 
+            self.reply(session, "ERROR: Unknown command")
+
+    def parse_update(self, command): # UPDATE [name|size|mtime] [ASC|DESC] [MATCH <шаблон>] [LIMIT n] [SINCE <версия>]
+        update_parts = command.split()[1:]
+        query = {"sort": None, "desc": False, "match": None, "limit": None, "since": None}
+        while update_parts:
+            part = update_parts.pop(0)
+            word = part.upper()
+            if word in ("SINCE", "LIMIT") and update_parts and update_parts[0].isdigit():
+                query[word.lower()] = int(update_parts.pop(0))
+            elif word == "MATCH" and update_parts: # шаблон имени файла, например "py*"
+                query["match"] = update_parts.pop(0)
+            elif word in ("ASC", "DESC"):
+                query["desc"] = word == "DESC"
+            elif part.lower() in SORT_KEYS and query["sort"] is None: # получение критерия сортировки
+                query["sort"] = part.lower()
+            else:
+                raise ValueError(f"Неверный параметр UPDATE: {part}")
+        if query["sort"] is None and (query["desc"] or query["limit"] is not None): # для LIMIT и DESC нужен порядок
+            query["sort"] = "name"
+        return query
+
+    def run_commands(self, session, commands): # команды выполняются по порядку, ответы идут в том же порядке
+        with session.send_lock:
+            for command in commands:
+                start = time.perf_counter()
+                self.handle_command(session, command)
+                name = command.split(None, 1)[0].upper() if command else ""
+                self.stats.record(name if name in COMMANDS else "UNKNOWN", time.perf_counter() - start)
+        self.flush_events(session) # события, пришедшие во время выполнения команд
+
+    def flush_events(self, session): # отправка накопленных событий WATCH, если соединение не занято ответом
+        while not session.events.empty():
+            if not session.send_lock.acquire(blocking=False): # отправит поток, выполняющий команду
+                return
+            try:
+                while not session.events.empty():
+                    self.send_event(session, session.events.get_nowait())
+            finally:
+                session.send_lock.release()
+
+    def close_session(self, session):
+        self.watcher.unsubscribe(session)
+        self.stats.add_connection(-1)
+        logging.info(f"Клиент отключился: {session.addr}")
+        session.connection.close()
+
+    def read_commands(self, session): # команды из сокета: None - клиент отключился
+        data = session.connection.recv(RECV_SIZE)
+        if not data:
+            return None
+        self.stats.add_traffic(received=len(data))
+        if session.framed is None: # размер кадра меньше 16 МиБ, поэтому первый байт кадра нулевой, а у текстовой команды - нет
+            session.framed = data[0] == 0
+        if not session.framed: # старые клиенты: одна команда на одно чтение
+            command = data.decode().strip()
+            return [command] if command else None
+        buffer = session.buffer
+        buffer += data
+        commands = []
+        while len(buffer) >= 4: # в одном чтении может быть несколько команд или часть команды
+            size = struct.unpack_from('!I', buffer)[0]
+            if size > MAX_COMMAND_SIZE:
+                raise ValueError(f"Слишком длинная команда: {size} байт")
+            if len(buffer) < 4 + size:
+                break
+            commands.append(buffer[4:4 + size].decode().strip())
+            del buffer[:4 + size]
+        return commands
+
+    def accept_client(self): # ожидание подключения клиента, получение сокета и адреса
+        connection, addr = self.socket_serv.accept()
+        try:
+            connection.setblocking(True) # команды обрабатываются в блокирующем режиме в рабочих потоках
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # ответы отправляются сразу, без задержки Нейгла
+        except OSError: # клиент сбросил соединение сразу после подключения
+            connection.close()
+            raise
+        self.stats.add_connection(1)
+        logging.info(f"Подключился клиент: {addr}")
+        print(f"Подключился клиент: {addr}")
+        return Session(connection, addr)
+
     def start(self):     # запуск сервера и обработки команд
+        if self.concurrent:
+            self.start_concurrent()
+            return
         while True:         
-            connection, addr = self.socket_serv.accept() # ожидание подключения клиента, получение сокета и адреса
-            logging.info(f"Подключился клиент: {addr}")
-            print(f"Подключился клиент: {addr}")
-            with connection: 
+            session = self.accept_client()
+            with session.connection: 
                 while True:   
                     try:
-                        command = connection.recv(1024).decode().strip()  # получение команды от клиента (до 1024 байт), декодирование и удаление пробелов
-                        if not command: # если команда пустая, выход из цикла
+                        commands = self.read_commands(session)
+                        if commands is None: # клиент отключился, выход из цикла
                             break
-                        logging.info(f"Получена команда: {command}")
-            
-                        if command.startswith("UPDATE"):
-                            update_parts = command.split()     
-                            sort = update_parts[1] if len(update_parts) > 1 else None # получение критерия сортировки
-                            if sort not in [None, "name", "size", "mtime"]: 
-                                connection.send(b"ERROR: Invalid sort criterion") 
-                                continue                 
-                            data = self.get_environment_data(sort) 
-                            self.save_to_file(data)
-                            self.send_file(connection) 
-                            logging.info("Данные обновлены и отправлены")
-                    
-                        elif command.startswith("SET "): 
-                            try:
-                                _, key, val, client_hash = command.split(" ", 3) # разделение команды на части: SET, ключ, значение, хеш     
-                                expected_hash = self.make_hash(f"SET {key} {val}") # вычисление ожидаемого хеша для проверки
-                                if client_hash != expected_hash:  # проверка совпадения хеша от клиента с ожидаемым 
-                                    connection.send(b"ERROR: Hash mismatch")
-                                    logging.warning(f"Ошибка хеша для команды SET от {addr}")
-                                    continue
-                                os.environ[key] = val # установка переменной окружения
-                                self.save_changes(key, val) # сохранение изменения в историю
-                                connection.send(b"OK") 
-                                logging.info(f"Установлена переменная: {key} = {val}")
-                            except ValueError:  
-                                connection.send(b"ERROR: Invalid SET command")
-                        
-                        else: 
-                            connection.send(b"ERROR: Unknown command")
+                        self.run_commands(session, commands)
                     except Exception as e: 
                         logging.error(f"Ошибка обработки команды: {e}")
                         break
+            self.close_session(session)
+
+    def start_concurrent(self): # одновременное обслуживание многих клиентов: selectors ждет команды, пул потоков их выполняет
+        selector = selectors.DefaultSelector()
+        self.socket_serv.setblocking(False)
+        selector.register(self.socket_serv, selectors.EVENT_READ)
+        wake_recv, self.wake_send = socket.socketpair() # будит цикл selectors, когда поток вернул соединение
+        selector.register(wake_recv, selectors.EVENT_READ)
+        self.ready = queue.SimpleQueue() # соединения, которые снова ждут команду
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                for key, _ in selector.select():
+                    if key.fileobj is self.socket_serv:
+                        try:
+                            session = self.accept_client()
+                        except BlockingIOError: # клиент успел отключиться до accept
+                            continue
+                        except OSError as e: # обрыв соединения до настройки, нехватка дескрипторов: сервер продолжает работу
+                            logging.error(f"Ошибка подключения клиента: {e}")
+                            if e.errno in (errno.EMFILE, errno.ENFILE): # соединение остается в очереди, не крутим цикл впустую
+                                time.sleep(0.1)
+                            continue
+                        selector.register(session.connection, selectors.EVENT_READ, session)
+                    elif key.fileobj is wake_recv:
+                        wake_recv.recv(4096)
+                        while not self.ready.empty():
+                            session = self.ready.get()
+                            selector.register(session.connection, selectors.EVENT_READ, session)
+                    else: # у клиента есть данные: пока команда выполняется, соединение не отслеживается
+                        selector.unregister(key.fileobj)
+                        pool.submit(self.serve_ready, key.data)
+
+    def serve_ready(self, session): # выполнение пришедших команд клиента в рабочем потоке
+        try:
+            commands = self.read_commands(session)
+            if commands is not None:
+                self.run_commands(session, commands)
+                self.ready.put(session)
+                self.wake_send.send(b"\0")
+                return
+        except Exception as e: 
+            logging.error(f"Ошибка обработки команды: {e}")
+        self.close_session(session) # пустая команда или ошибка - закрываем соединение
 
 class Client:
-    def __init__(self, host='127.0.0.1', port=57535): 
+    def __init__(self, host='127.0.0.1', port=57535, encodings=None): 
         self.my_host = host 
         self.my_port = port 
         self.socket_cl = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  
+        self.socket_cl.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_SIZE) # крупные чтения при больших снимках
         self.socket_cl.connect((self.my_host, self.my_port))
+        self.last_response_size = 0 # размер последнего полученного ответа в байтах
+        self.snapshot = None # последний полученный снимок, к нему применяются изменения UPDATE SINCE
+        self.snapshot_query = None # команда UPDATE, которой получен снимок
         logging.basicConfig(filename='client.log', level=logging.INFO, # настройка логирования: запись в файл client.log, уровень INFO, формат с временем
                             format='%(asctime)s - %(message)s')
         logging.info("клиент запущен и подключен к серверу") 
         print(f"клиент подключен к серверу {self.my_host}:{self.my_port}") 
+        self.encoding = "json" # формат ответов UPDATE, согласованный с сервером
+        if encodings:
+            self.negotiate(encodings)
+
+    def negotiate(self, encodings): # команда HELLO: сервер выбирает первый поддерживаемый формат из списка
+        self.send_request(f"HELLO {' '.join(encodings)}")
+        response = self.recv_response().decode()
+        if response.startswith("OK "):
+            self.encoding = response.split()[1]
+        logging.info(f"Формат ответов: {self.encoding}")
+
+    def recv_into_exact(self, view): # заполнение memoryview данными из сокета без промежуточных bytes
+        while view:
+            received = self.socket_cl.recv_into(view, min(len(view), RECV_SIZE))
+            if not received:
+                raise ConnectionError("Сервер закрыл соединение")
+            view = view[received:]
+
+    def decode_response(self, data, encoding): # разбор ответа в согласованном формате
+        if encoding.endswith("+zlib"):
+            data = zlib.decompress(data)
+        result = json.loads(data) # разбор JSON прямо из байтов, без отдельного decode
+        if encoding.startswith("columnar") and "directories" in result: # столбцы директорий обратно в список файлов
+            result["directories"] = {directory: [{"name": n, "size": s, "mtime": m}
+                                                 for n, s, m in zip(c["name"], c["size"], c["mtime"])]
+                                     for directory, c in result["directories"].items()}
+        return result
+
+    def send_request(self, command): # команда кадром: размер в первых 4 байтах, затем текст
+        data = command.encode()
+        self.socket_cl.sendall(struct.pack('!I', len(data)) + data)
+
+    def pipeline(self, commands): # отправка всех команд сразу, без ожидания ответов; ответы приходят по порядку
+        self.socket_cl.sendall(b"".join(struct.pack('!I', len(data)) + data for data in (c.encode() for c in commands)))
+        return [self.recv_response() for _ in commands]
 
-    def get_file(self): # получение файла от сервера
+    def recv_response(self): # получение ответа от сервера: кадры с размером в первых 4 байтах до пустого кадра
+        data = bytearray() # буфер растет по объявленным размерам кадров с удвоением, а не на каждый пакет
+        size = 0
+        header = bytearray(4)
+        while True:
+            self.recv_into_exact(memoryview(header))
+            frame_size = struct.unpack('!I', header)[0]  # распаковка размера кадра из 4 байтов в целое число
+            if frame_size == 0: # пустой кадр - конец ответа
+                break
+            if size + frame_size > len(data):
+                data += bytes(max(len(data), size + frame_size - len(data)))
+            with memoryview(data) as view:
+                self.recv_into_exact(view[size:size + frame_size]) # кадр читается сразу на свое место в буфере
+            size += frame_size
+        del data[size:] # обрезка хвоста буфера без копирования данных
+        self.last_response_size = size
+        return data
+
+    def get_file(self, encoding="json"): # получение и разбор данных от сервера
         try:
-            size_data = self.socket_cl.recv(4)  # получение первых 4 байтов, содержащих размер файла
-            if not size_data:
+            data = self.recv_response()
+            if data.startswith(b"ERROR"): # текстовая ошибка вместо данных
+                print(f"Ответ сервера: {data.decode()}")
+                logging.error(f"Получен ответ: {data.decode()}")
                 return None
-            file_size = struct.unpack('!I', size_data)[0]  # распаковка размера файла из 4 байтов в целое число
-            data = b""  # инициализация пустой строки байтов для хранения данных
-            while len(data) < file_size:    # получение данных, пока не будет получен весь файл
-                packet = self.socket_cl.recv(min(file_size - len(data), 1024)) # сколько байтов осталось получить
-                if not packet:     
-                    break
-                data += packet # добавление полученного пакета к данным
-            return json.loads(data.decode()) # декодирование полученных байтов в строку и преобразование из JSON в объект Python
+            return self.decode_response(data, encoding)
         except Exception as e:
             logging.error(f"Ошибка при получении файла: {e}")
             return None
@@ -156,43 +1127,130 @@ class Client:
         if not data:  
             print("Ошибка: данные не получены")
             return
-        print("\n=== Переменные окружения ===") 
-        for key, val in data["variables"].items():  # цикл по всем переменным окружения
-            print(f"{key}: {val}")             # вывод каждой пары ключ-значение
+        if "variables" in data:
+            print("\n=== Переменные окружения ===") 
+            for key, val in data["variables"].items():  # цикл по всем переменным окружения
+                print(f"{key}: {val}")             # вывод каждой пары ключ-значение
+        if "files" in data: # ответ UPDATE ... LIMIT n
+            print("\n=== Исполняемые файлы ===")
+            for f in data["files"]:
+                print(f"  - {os.path.join(f['directory'], f['name'])} (размер: {f['size']} байт, изменен: {f['mtime']})")
+        if "directories" not in data:
+            return
         print("\n=== Исполняемые файлы в директориях PATH ===")
+        if data.get("timed_out"): # сервер не дождался сканирования этих директорий
+            print(f"Внимание: данные неполные или устаревшие для {', '.join(data['timed_out'])}")
         for directory, files in data["directories"].items():  # проходим по всем директориям и по всем файлам каждой из них
             print(f"{directory}:")     
             for f in files: 
                 print(f"  - {f['name']} (размер: {f['size']} байт, изменен: {f['mtime']})") 
 
+    def show_history(self, key, records): # отображение истории изменений переменной
+        if records is None:
+            print("Ошибка: данные не получены")
+            return
+        print(f"\n=== История {key} ===")
+        if not records:
+            print("Изменений нет")
+        for record in records:
+            print(f"{record['timestamp']}: {record['value']}")
+
     def make_hash(self, data): # создание хеша из строки данных
         return hashlib.sha256(data.encode()).hexdigest() 
 
+    def mset_command(self, pairs): # команда MSET: по строке "<ключ> <значение> <хеш SET>" на присваивание
+        return "MSET\n" + "\n".join(f"{key} {val} {self.make_hash(f'SET {key} {val}')}" for key, val in pairs)
+
+    def apply_update(self, data, query): # обновление сохраненного снимка полным ответом или изменениями
+        if not data:
+            return None
+        if "files" in data: # ответ с LIMIT - выборка, а не снимок
+            return data
+        if data.get("delta"):
+            variables = self.snapshot["variables"]
+            variables.update(data["variables"]["set"])
+            for key in data["variables"]["removed"]:
+                variables.pop(key, None)
+            old = self.snapshot["directories"] # неизмененные директории берем из прошлого снимка
+            directories = {d: data["directories"].get(d, old.get(d)) for d in data["order"]}
+            self.snapshot["directories"] = {d: files for d, files in directories.items() if files}
+            self.snapshot["version"] = data["version"]
+            self.snapshot["timed_out"] = data["timed_out"]
+        else:
+            self.snapshot = data
+        self.snapshot_query = query
+        return self.snapshot
+
     def send_command(self, command): # отправка команды серверу и получения ответа
         try:
-            self.socket_cl.send(command.encode()) # кодирование команды в байты и отправка серверу
+            if command.startswith("UPDATE"):
+                query = command
+                if self.snapshot is not None and self.snapshot_query == query and "SINCE" not in query.upper():
+                    command += f" SINCE {self.snapshot['version']}" # запрашиваем только изменения с прошлого снимка
+            self.send_request(command) # кодирование команды в байты и отправка серверу
             logging.info(f"Отправлена команда: {command}") 
             if command.startswith("UPDATE"):
-                data = self.get_file() # получение данных от сервера (JSON-файл) и их отображение
-                self.show_info(data) 
+                data = self.get_file(self.encoding) # получение данных от сервера и их отображение
+                self.show_info(self.apply_update(data, query)) 
+            elif command.startswith("VARS"):
+                self.show_info(self.get_file())
+            elif command == "STATS":
+                print(json.dumps(self.get_file(), indent=4, ensure_ascii=False))
+            elif command.startswith("HISTORY "):
+                records = self.get_file() # история приходит так же, как данные UPDATE
+                self.show_history(command.split()[1], records)
             else:
-                response = self.socket_cl.recv(1024).decode() # получение текстового ответа от сервера (до 1024 байт)
+                response = self.recv_response().decode() # получение текстового ответа от сервера
                 print(f"Ответ сервера: {response}") 
                 logging.info(f"Получен ответ: {response}")  
         except Exception as e:
             logging.error(f"Ошибка при отправке команды: {e}")
 
+    def watch(self): # вывод событий сервера до Ctrl+C
+        self.send_request("WATCH")
+        print(f"Ответ сервера: {self.recv_response().decode()}")
+        try:
+            while True:
+                event = json.loads(self.recv_response())
+                if event["event"] == "set":
+                    print(f"SET {event['key']} = {event['value']}")
+                else:
+                    print(f"{event['event']}: {os.path.join(event['directory'], event['name'])} "
+                          f"(размер: {event['size']} байт, изменен: {event['mtime']})")
+        except KeyboardInterrupt:
+            self.send_request("UNWATCH")
+            while not self.recv_response().startswith(b"OK"): # события, отправленные до UNWATCH
+                pass
+
     def start(self): # запуск клиента и взаимодействие с пользователем
         while True: 
             print("\nКоманды:")
-            print("1. UPDATE [name|size|mtime] - обновить данные с сортировкой")
+            print("1. UPDATE [name|size|mtime] [ASC|DESC] [MATCH <шаблон>] [LIMIT n] - обновить данные с сортировкой")
             print("2. SET <key> <value> - установить переменную")
-            print("3. EXIT - выйти")
+            print("3. HISTORY <key> [LIMIT n] - последние изменения переменной")
+            print("4. MSET <key>=<value> [<key>=<value> ...] - установить несколько переменных за один запрос")
+            print("5. VARS [prefix] - переменные окружения с префиксом")
+            print("6. WATCH - следить за изменениями (Ctrl+C - остановить)")
+            print("7. STATS - статистика сервера")
+            print("8. EXIT - выйти")
             user_choice = input("Введите команду: ").strip()            
             if user_choice.upper() == "EXIT":
                 break
-            elif user_choice.upper().startswith("UPDATE"): 
+            elif user_choice.upper().startswith(("UPDATE", "VARS")): # шаблон MATCH и префикс VARS чувствительны к регистру
+                command_word, _, rest = user_choice.partition(" ")
+                self.send_command(f"{command_word.upper()} {rest}".strip())
+            elif user_choice.upper().startswith("HISTORY "):
                 self.send_command(user_choice.upper())
+            elif user_choice.upper() == "WATCH":
+                self.watch()
+            elif user_choice.upper() == "STATS":
+                self.send_command("STATS")
+            elif user_choice.upper().startswith("MSET "):
+                pairs = [pair.split("=", 1) for pair in user_choice.upper().split()[1:]]
+                if all(len(pair) == 2 and pair[0] for pair in pairs):
+                    self.send_command(self.mset_command(pairs))
+                else:
+                    print("Ошибка: неверный формат команды MSET")
             elif user_choice.upper().startswith("SET "): 
                 set_parts = user_choice.upper().split(" ", 2) 
                 if len(set_parts) == 3: # проверка, что команда содержит ключ и значение
@@ -209,25 +1267,34 @@ class Client:
         print("Соединение закрыто")
 
 def main():
-    if len(sys.argv) != 2:
-        print("Использование: python 1lab/main.py [server|client]")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Сервер и клиент переменных окружения")
+    parser.add_argument("mode", choices=["server", "client"], type=str.lower)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=57535)
+    parser.add_argument("--backlog", type=int, default=64, help="очередь ожидающих подключений сервера")
+    parser.add_argument("--workers", type=int, default=8, help="число потоков, выполняющих команды")
+    parser.add_argument("--sequential", action="store_true", help="обслуживать клиентов по одному")
+    parser.add_argument("--scan-workers", type=int, default=8, help="число потоков сканирования директорий PATH")
+    parser.add_argument("--scan-timeout", type=float, default=2.0, help="время ожидания сканирования одной директории с его начала, с")
+    parser.add_argument("--save-snapshot", action="store_true", help="сохранять отправленный снимок в data_environment.json")
+    parser.add_argument("--cache-size", type=int, default=RESPONSE_CACHE_SIZE // (1024 * 1024),
+                        help="предел памяти кеша готовых ответов UPDATE, МБ (0 - без кеша)")
+    parser.add_argument("--stats-interval", type=float, help="период записи статистики в server.log, с")
+    parser.add_argument("--cache-ttl", type=float, default=RESPONSE_CACHE_TTL, help="время жизни готового ответа UPDATE, с")
+    parser.add_argument("--encoding", nargs="+", default=["columnar+zlib", "json"], choices=ENCODINGS,
+                        help="форматы ответов UPDATE, которые клиент предлагает серверу")
+    args = parser.parse_args()
     
-    mode = sys.argv[1].lower()
-    
-    if mode == "server":
-        server = Server()
+    if args.mode == "server":
+        server = Server(args.host, args.port, backlog=args.backlog, workers=args.workers,
+                        concurrent=not args.sequential, save_snapshot=args.save_snapshot,
+                        scan_workers=args.scan_workers, scan_timeout=args.scan_timeout,
+                        response_cache_size=args.cache_size * 1024 * 1024, response_cache_ttl=args.cache_ttl,
+                        stats_interval=args.stats_interval)
         server.start()  # запустить сервер
-    elif mode == "client":
-        client = Client()
-        client.start()  # запустить клиента
     else:
-        print("Неизвестный режим. Используйте 'server' или 'client'.")
-        sys.exit(1)
+        client = Client(args.host, args.port, encodings=args.encoding)
+        client.start()  # запустить клиента
 
 if __name__ == "__main__":
-        print("Неизвестный режим. Используйте 'server' или 'client'")
-        sys.exit(1)
-
-if name == "main":
     main()
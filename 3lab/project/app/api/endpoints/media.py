@@ -1,43 +1,277 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile
-from app.schemas.media import ImageBinarizationRequest
-import base64
+import asyncio
+import binascii
+import json
+import os
+import shutil
+import tempfile
+import zipfile
 from io import BytesIO
-from PIL import Image
-import numpy as np
-from skimage import filters
+from fastapi import APIRouter, Depends, HTTPException, File, Form, UploadFile, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from app.core.config import settings
+from app.schemas.media import ImageBinarizationRequest
+from app.services.image_processing import (decode_base64_image, binarize_to_file, binarize_to_path,
+                                           check_image_size, encode_base64, OUTPUT_FORMATS)
+from app.services.result_cache import result_cache, cache_key
+from app.services.tiling import ImageTooLarge
+from app.services.worker_pool import run_in_pool, PoolBusy
 
 router = APIRouter()
 
+RESPONSE_CHUNK_SIZE = 64 * 1024  # размер части потокового ответа с изображением
+MEDIA_TYPE_FORMATS = {media_type: name for name, (_, _, media_type) in OUTPUT_FORMATS.items()}  # MIME-тип -> формат
+OUTPUT_MEDIA_TYPES = tuple(MEDIA_TYPE_FORMATS)  # форматы ответа /binary_image/raw в порядке предпочтения
+
+def busy_error() -> HTTPException:  # пул бинаризации переполнен: клиенту лучше повторить позже
+    return HTTPException(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+
+def too_large_error(e: Exception) -> HTTPException:  # изображение не помещается в бюджет памяти
+    return HTTPException(status_code=413, detail=str(e))
+
+async def binarize_cached(image_data: bytes, algorithm: str, output_format: str, window_size: int, k: float) -> bytes:
+    # при попадании в кеш результат отдается без процесса пула; хеширование и диск - в пуле потоков
+    key = await run_in_threadpool(cache_key, image_data, algorithm, output_format, window_size, k)
+    result = await run_in_threadpool(result_cache.get, key)
+    if result is None:
+        # размеры из заголовка: слишком большое изображение получает 413, не занимая процесс пула
+        await run_in_threadpool(check_image_size, image_data, algorithm, window_size)
+        result = await run_in_pool(binarize_to_file, image_data, algorithm, output_format, window_size, k)
+        await run_in_threadpool(result_cache.put, key, result)
+    return result
+
+def image_json(result: bytes) -> Response:
+    # {"binarized_image": base64} собирается из байтов: без промежуточной строки и json.dumps по всему результату
+    return Response(b"".join((b'{"binarized_image": "', binascii.b2a_base64(result, newline=False), b'"}')),
+                    media_type="application/json")
+
 @router.post("/binary_image/json") # эндпоинт для JSON-запроса
 async def binary_image_json(request: ImageBinarizationRequest):
     try:
-        image_data = base64.b64decode(request.image)     # декодируем строку base64 в изображение
-        image = Image.open(BytesIO(image_data)).convert("L")
-        if request.algorithm.lower() != "niblack":         # применяем бинаризацию
-            raise HTTPException(status_code=400, detail="Only 'niblack' algorithm is supported")
-        image_array = np.array(image)
-        threshold = filters.threshold_niblack(image_array)
-        binarized_array = image_array > threshold
-        binarized_image = Image.fromarray(binarized_array.astype(np.uint8) * 255)
-        buffered = BytesIO()
-        binarized_image.save(buffered, format="PNG")
-        binarized_image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        return {"binarized_image": binarized_image_base64}
+        # base64 декодируется и проверяется один раз здесь: по байтам изображения ищем результат в кеше
+        image_data = await run_in_threadpool(decode_base64_image, request.image)
+        result = await binarize_cached(image_data, request.algorithm, request.output_format, request.window_size, request.k)
+        return image_json(result)
+    except PoolBusy:
+        raise busy_error()
+    except ImageTooLarge as e:
+        raise too_large_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
 
 @router.post("/binary_image") # эндпоинт для загрузки файла
-async def binary_image_file(image: UploadFile = File(...)):
+async def binary_image_file(image: UploadFile = File(...), algorithm: str = Form("niblack"),
+                            output_format: str = Form("png"), window_size: int = Form(15), k: float = Form(0.2)):
     try:
         image_data = await image.read() # читаем файл
-        image = Image.open(BytesIO(image_data)).convert("L")
-        image_array = np.array(image) # бинаризация
-        threshold = filters.threshold_niblack(image_array)
-        binarized_array = image_array > threshold
-        binarized_image = Image.fromarray(binarized_array.astype(np.uint8) * 255)
-        buffered = BytesIO()
-        binarized_image.save(buffered, format="PNG")
-        binarized_image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        return {"binarized_image": binarized_image_base64}
+        result = await binarize_cached(image_data, algorithm, output_format, window_size, k)
+        return image_json(result)
+    except PoolBusy:
+        raise busy_error()
+    except ImageTooLarge as e:
+        raise too_large_error(e)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
+
+
+def negotiate_media_type(accept: str | None) -> str:  # первый поддерживаемый тип из заголовка Accept
+    if not accept:
+        return OUTPUT_MEDIA_TYPES[0]
+    for item in accept.split(","):
+        media_type = item.split(";")[0].strip().lower()
+        if media_type in ("*/*", "image/*"):
+            return OUTPUT_MEDIA_TYPES[0]
+        if media_type in OUTPUT_MEDIA_TYPES:
+            return media_type
+    raise HTTPException(status_code=406, detail=f"Supported response types: {', '.join(OUTPUT_MEDIA_TYPES)}")
+
+def spool_file() -> tempfile.NamedTemporaryFile:  # временный файл для большой загрузки; путь передается процессу пула
+    return tempfile.NamedTemporaryFile(dir=settings.SPOOL_DIR, delete=False)
+
+async def spool_body(request: Request) -> bytes | str:
+    # тело запроса: до SPOOL_MAX_SIZE - байты в памяти, больше - временный файл, путь к которому возвращается
+    buffer, spool = bytearray(), None
+    async for chunk in request.stream():
+        if spool is None and len(buffer) + len(chunk) > settings.SPOOL_MAX_SIZE:
+            spool = spool_file()
+            spool.write(buffer)
+            buffer = None
+        if spool is not None:
+            await run_in_threadpool(spool.write, chunk)
+        else:
+            buffer += chunk
+    if spool is None:
+        return bytes(buffer)
+    spool.close()
+    return spool.name
+
+def spool_upload(upload) -> str:  # большой multipart-файл копируется во временный файл с именем
+    with spool_file() as spool:
+        shutil.copyfileobj(upload.file, spool)
+    return spool.name
+
+def remove_file(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def iter_chunks(data: bytes):  # отдаем результат частями без копирования
+    view = memoryview(data)
+    for start in range(0, len(view), RESPONSE_CHUNK_SIZE):
+        yield view[start:start + RESPONSE_CHUNK_SIZE]
+
+@router.post("/binary_image/raw") # эндпоинт без base64: изображение в теле запроса или multipart, в ответе - сам файл
+async def binary_image_raw(request: Request, algorithm: str = "niblack", output_format: str | None = None,
+                           window_size: int = 15, k: float = 0.2):
+    if output_format is None:  # формат из параметра запроса важнее заголовка Accept
+        media_type = negotiate_media_type(request.headers.get("accept"))
+        output_format = MEDIA_TYPE_FORMATS[media_type]
+    elif output_format in OUTPUT_FORMATS:
+        media_type = OUTPUT_FORMATS[output_format][2]
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported output format: {output_format}")
+    image_data = None
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("image")
+            if not isinstance(upload, StarletteUploadFile):
+                raise ValueError("Multipart request must contain an 'image' file")
+            if upload.size is not None and upload.size > settings.SPOOL_MAX_SIZE:
+                image_data = await run_in_threadpool(spool_upload, upload)
+            else:
+                image_data = await upload.read()
+        else:
+            image_data = await spool_body(request)  # тело запроса - байты изображения
+        if not image_data:
+            raise ValueError("Empty image")
+        if isinstance(image_data, str):  # большое изображение: результат тоже через временный файл, без кеша
+            await run_in_threadpool(check_image_size, image_data, algorithm, window_size)
+            result_path = await run_in_pool(binarize_to_path, image_data, algorithm, output_format, window_size, k)
+            return FileResponse(result_path, media_type=media_type, background=BackgroundTask(remove_file, result_path))
+        result = await binarize_cached(image_data, algorithm, output_format, window_size, k)
+    except PoolBusy:
+        raise busy_error()
+    except ImageTooLarge as e:
+        raise too_large_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
+    finally:
+        if isinstance(image_data, str):
+            remove_file(image_data)
+    return StreamingResponse(iter_chunks(result), media_type=media_type,
+                             headers={"Content-Length": str(len(result))})
+
+def is_zip(upload) -> bool:
+    return upload.content_type in ("application/zip", "application/x-zip-compressed") or \
+        (upload.filename or "").lower().endswith(".zip")
+
+def zip_items(archive: zipfile.ZipFile) -> list:  # (имя, функция чтения) для каждого файла архива
+    items = []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        if info.file_size > settings.BATCH_MAX_ITEM_SIZE:  # размер из заголовка проверяем до распаковки
+            items.append((info.filename, None))
+        else:
+            items.append((info.filename, lambda info=info: archive.read(info)))
+    return items
+
+def upload_reader(upload):  # чтение загруженного файла в пуле потоков; файл читается только при обработке
+    def read() -> bytes:
+        upload.file.seek(0)
+        return upload.file.read(settings.BATCH_MAX_ITEM_SIZE + 1)
+    return read
+
+async def collect_batch_items(request: Request, resources: list) -> list:
+    # изображения пакета: файлы multipart-поля images и содержимое zip-архивов; в resources - что закрыть после ответа
+    items = []
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form(max_files=settings.BATCH_MAX_ITEMS)
+        resources.append(form)
+        for upload in form.getlist("images"):
+            if not isinstance(upload, StarletteUploadFile):
+                raise ValueError("Field 'images' must contain files")
+            if is_zip(upload):
+                archive = await run_in_threadpool(zipfile.ZipFile, upload.file)
+                resources.append(archive)
+                items.extend(zip_items(archive))
+            else:
+                items.append((upload.filename, upload_reader(upload)))
+    else:  # тело запроса - zip-архив
+        body = await spool_body(request)
+        if isinstance(body, str):
+            resources.append(body)
+        archive = await run_in_threadpool(zipfile.ZipFile, body if isinstance(body, str) else BytesIO(body))
+        resources.append(archive)
+        items.extend(zip_items(archive))
+    if not items:
+        raise ValueError("Batch contains no images")
+    if len(items) > settings.BATCH_MAX_ITEMS:
+        raise ValueError(f"Batch contains more than {settings.BATCH_MAX_ITEMS} images")
+    return items
+
+async def close_batch_resources(resources: list):
+    for resource in resources:
+        if isinstance(resource, str):
+            remove_file(resource)
+        elif isinstance(resource, zipfile.ZipFile):
+            resource.close()
+        else:
+            await resource.close()  # форма закрывает свои временные файлы
+
+async def iter_batch_results(items: list, resources: list, algorithm: str, output_format: str, window_size: int, k: float):
+    # строки NDJSON в порядке готовности: первые страницы приходят, пока остальные еще обрабатываются
+    semaphore = asyncio.Semaphore(settings.BINARIZATION_WORKERS)  # пакет занимает не больше процессов, чем их есть
+
+    async def process(index: int, filename: str, read):
+        async with semaphore:
+            line = {"index": index, "filename": filename}
+            try:
+                if read is None:
+                    raise ImageTooLarge(f"Image is larger than {settings.BATCH_MAX_ITEM_SIZE} bytes")
+                image_data = await run_in_threadpool(read)
+                if len(image_data) > settings.BATCH_MAX_ITEM_SIZE:
+                    raise ImageTooLarge(f"Image is larger than {settings.BATCH_MAX_ITEM_SIZE} bytes")
+                result = await binarize_cached(image_data, algorithm, output_format, window_size, k)
+                line["binarized_image"] = encode_base64(result)
+            except PoolBusy:  # ошибка одного изображения не прерывает пакет
+                line["error"] = "Server is busy, try again later"
+            except Exception as e:
+                line["error"] = f"Error processing image: {str(e)}"
+            return line
+
+    tasks = [asyncio.create_task(process(index, filename, read)) for index, (filename, read) in enumerate(items)]
+    failed = 0
+    try:
+        for future in asyncio.as_completed(tasks):
+            line = await future
+            failed += "error" in line
+            yield json.dumps(line).encode() + b"\n"
+        yield json.dumps({"count": len(tasks), "failed": failed}).encode() + b"\n"  # итоговая строка
+    finally:
+        for task in tasks:  # клиент отключился - оставшиеся изображения не обрабатываем
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_batch_resources(resources)
+
+@router.post("/binary_image/batch") # пакет изображений: файлы images в multipart и/или zip-архивы, ответ - NDJSON
+async def binary_image_batch(request: Request, algorithm: str = "niblack", output_format: str = "png",
+                             window_size: int = 15, k: float = 0.2):
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported output format: {output_format}")
+    resources = []
+    try:
+        items = await collect_batch_items(request, resources)
+    except Exception as e:
+        await close_batch_resources(resources)
+        raise HTTPException(status_code=400, detail=f"Error reading batch: {str(e)}")
+    return StreamingResponse(iter_batch_results(items, resources, algorithm, output_format, window_size, k),
+                             media_type="application/x-ndjson")
+
+@router.get("/cache_stats") # попадания в кеш результатов этого процесса и размер кеша
+async def cache_stats():
+    return result_cache.stats()
@@ -1,3 +1,4 @@
+import os
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
 
@@ -9,6 +10,21 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     DATABASE_URL: str = "sqlite:///./app.db"
     REDIS_DB_PATH: str = "/mnt/c/Users/kseni/PPP_24-25_4sem/3lab/project/redis.db"  
+    BINARIZATION_WORKERS: int = os.cpu_count() or 1  # процессы для бинаризации изображений
+    BINARIZATION_QUEUE_DEPTH: int = 16  # сколько запросов может ждать свободный процесс, остальные получают 503
+    BINARIZATION_MEMORY_BUDGET: int = 1024 * 1024 * 1024  # пик памяти на одно изображение, байт; больше - обработка полосами
+    MAX_IMAGE_PIXELS: int = 1_000_000_000  # изображения больше отклоняются по заголовку, до декодирования;
+    # скан 20000x30000 (600 МП) в оттенках серого или цветной JPEG с локальным порогом укладывается в бюджет 1 ГБ;
+    # другие режимы и otsu (копия изображения) для таких размеров отклоняются по бюджету памяти
+    SPOOL_MAX_SIZE: int = 16 * 1024 * 1024  # загрузки и результаты больше этого размера хранятся во временных файлах
+    SPOOL_DIR: str | None = None  # директория временных файлов, по умолчанию системная
+    BATCH_MAX_ITEMS: int = 500  # сколько изображений можно прислать в одном пакете
+    BATCH_MAX_ITEM_SIZE: int = 64 * 1024 * 1024  # предел размера одного изображения пакета (в том числе распакованного из zip)
+    RESULT_CACHE_MEMORY: int = 256 * 1024 * 1024  # кеш результатов бинаризации в памяти каждого процесса, байт
+    RESULT_CACHE_DIR: str = "./result_cache"  # общий для сервера и Celery дисковый кеш результатов
+    RESULT_CACHE_DISK: int = 2 * 1024 * 1024 * 1024  # предел дискового кеша, байт (0 - без дискового кеша)
+    BACKEND_PROFILE: str = "./backend_profile.json"  # самые быстрые бэкенды бинаризации по размерам изображений
+    BACKEND_CALIBRATE: bool = False  # замерить бэкенды при запуске сервера, если профиля еще нет
 
     class Config:
         env_file = ".env"
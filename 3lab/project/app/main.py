@@ -7,11 +7,21 @@ from fastapi import FastAPI, WebSocket, Header
 import uvicorn
 from app.api.endpoints import auth, media 
 from app.websocket.handlers import websocket_endpoint
+from app.services.worker_pool import shutdown_pool
+from app.services.backends import ensure_profile
 
 app = FastAPI()
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(media.router, prefix="/image", tags=["image"])
 
+@app.on_event("startup")
+def calibrate_backends():  # профиль бэкендов пишется до первого запроса: процессы пула читают его при запуске
+    ensure_profile()
+
+@app.on_event("shutdown")
+def stop_worker_pool():  # завершение процессов бинаризации вместе с сервером
+    shutdown_pool()
+
 @app.websocket("/ws")
 async def ws_endpoint(websocket: WebSocket, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
@@ -2,4 +2,7 @@ from pydantic import BaseModel
 
 class ImageBinarizationRequest(BaseModel):
     image: str 
-    algorithm: str = "niblack"  
\ No newline at end of file
+    algorithm: str = "niblack"  # niblack, sauvola, wolf, gaussian (адаптивный по Гауссу) или otsu (глобальный)
+    output_format: str = "png"  # png (1 бит на пиксель) или tiff (CCITT Group 4)
+    window_size: int = 15  # нечетный размер окна локальных алгоритмов
+    k: float = 0.2  # вес отклонения (Niblack T = m - k * s, Sauvola, Wolf) или смещение порога (gaussian)  
\ No newline at end of file
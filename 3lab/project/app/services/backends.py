@@ -0,0 +1,293 @@
+import bisect
+import json
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+from app.core.config import settings
+from app.services.niblack import ROWS_PER_BLOCK, padding, table_dtype, iter_padded_statistics
+
+try:  # необязательные реализации: без пакета его бэкенды просто не регистрируются
+    import cv2
+except ImportError:
+    cv2 = None
+try:
+    from skimage import filters
+except ImportError:
+    filters = None
+
+logger = logging.getLogger(__name__)
+
+LOCAL_ALGORITHMS = ("niblack", "sauvola", "wolf", "gaussian")  # порог по окрестности пикселя, считается полосами
+GLOBAL_ALGORITHMS = ("otsu",)  # один порог на все изображение
+ALGORITHMS = LOCAL_ALGORITHMS + GLOBAL_ALGORITHMS
+BACKEND_ORDER = ("numpy", "opencv", "skimage")  # выбор без профиля калибровки: первый доступный
+SIZE_BUCKETS = (256 * 256, 1024 * 1024, 4096 * 4096)  # границы корзин размера изображения в пикселях
+CALIBRATION_SIZES = ((128, 128), (512, 512), (2048, 2048), (4096, 4608))  # по одному изображению на корзину
+SAUVOLA_R = 127.5  # динамический диапазон отклонения для uint8, как в skimage
+GAUSSIAN_TRUNCATE = 4.0  # радиус ядра Гаусса в сигмах, как в scipy.ndimage
+
+# алгоритм -> имя бэкенда -> (функция порога, оценка памяти на полосу)
+# функция порога локального алгоритма: (полоса с halo строками запаса сверху и снизу, halo, окно, k, параметры
+# изображения) -> блоки (строка без запаса, порог); глобального: (изображение) -> порог
+BACKENDS = {algorithm: {} for algorithm in ALGORITHMS}
+profile_choices = None  # алгоритм -> бэкенд для каждой корзины из профиля; читается при первом выборе
+
+def algorithm_halo(algorithm: str, window_size: int) -> int:  # сколько строк запаса нужно полосе
+    if algorithm == "gaussian":
+        return int(GAUSSIAN_TRUNCATE * gaussian_sigma(window_size) + 0.5)
+    if algorithm in GLOBAL_ALGORITHMS:
+        return 0
+    return padding(window_size)[0]
+
+def integral_memory(rows: int, width: int, window_size: int, halo: int) -> int:
+    # таблицы сумм: полоса и ее дополненная копия, квадраты, две таблицы, маска, временные массивы одного блока
+    itemsize = np.dtype(table_dtype(np.zeros(0, np.uint8), window_size)).itemsize
+    padded = (rows + window_size) * (width + window_size)
+    return padded * (1 + 1 + 2 + 2 * itemsize) + rows * width + min(rows, ROWS_PER_BLOCK) * width * 48
+
+def gaussian_memory(rows: int, width: int, window_size: int, halo: int) -> int:
+    # свертка блоками строк: полоса, маска и float64-массивы одного блока
+    block = min(rows, ROWS_PER_BLOCK) + 2 * halo
+    return (rows + 2 * halo) * width + rows * width + block * (width + 2 * halo) * 48
+
+def array_memory(bytes_per_pixel: int):  # бэкенды, считающие порог сразу для всей полосы
+    def memory(rows: int, width: int, window_size: int, halo: int) -> int:
+        return (rows + 2 * halo) * width * (1 + bytes_per_pixel) + rows * width
+    return memory
+
+def compare_memory(rows: int, width: int, window_size: int, halo: int) -> int:  # глобальный порог: полоса и маска
+    return rows * width * 2
+
+def numpy_statistics(strip: np.ndarray, halo: int, window_size: int):
+    # среднее и отклонение по таблицам сумм; дополненную копию полосы держит только генератор таблиц
+    before, after = padding(window_size)
+    yield from iter_padded_statistics(
+        np.pad(strip[halo - before:len(strip) - halo + after], ((0, 0), (before, after)), mode="reflect"),
+        window_size, table_dtype(strip, window_size))
+
+def opencv_statistics(strip: np.ndarray, halo: int, window_size: int):
+    # то же фильтрами OpenCV с отражением у краев как в np.pad(mode="reflect")
+    size = (window_size, window_size)
+    mean = cv2.boxFilter(strip, cv2.CV_64F, size, borderType=cv2.BORDER_REFLECT_101)
+    std = cv2.sqrBoxFilter(strip, cv2.CV_64F, size, borderType=cv2.BORDER_REFLECT_101)
+    std -= np.square(mean)
+    np.maximum(std, 0, out=std)  # погрешность округления не дает отрицательной дисперсии
+    np.sqrt(std, out=std)
+    yield 0, mean[halo:len(strip) - halo], std[halo:len(strip) - halo]
+
+STATISTICS = {"numpy": numpy_statistics}  # бэкенд -> среднее и отклонение по окну
+if cv2 is not None:
+    STATISTICS["opencv"] = opencv_statistics
+
+def apply_formula(algorithm: str, mean: np.ndarray, std: np.ndarray, k: float, params: dict) -> np.ndarray:
+    # порог из среднего и отклонения, на месте в массивах блока
+    if algorithm == "niblack":  # T = m - k * s
+        std *= k
+        mean -= std
+    elif algorithm == "sauvola":  # T = m * (1 + k * (s / R - 1))
+        std *= k / SAUVOLA_R
+        std += 1 - k
+        mean *= std
+    else:  # wolf: T = m - k * (1 - s / R) * (m - M), R - наибольшее отклонение, M - наименьшая яркость изображения
+        std *= -1 / (params["max_std"] or 1.0)
+        std += 1
+        std *= k
+        std *= mean - params["minimum"]
+        mean -= std
+    return mean
+
+def statistics_threshold(statistics, algorithm: str):
+    def threshold(strip: np.ndarray, halo: int, window_size: int, k: float, params: dict):
+        for start, mean, std in statistics(strip, halo, window_size):
+            yield start, apply_formula(algorithm, mean, std, k, params)
+    return threshold
+
+def gaussian_sigma(window_size: int) -> float:  # окно покрывает +-3 сигмы, как в skimage.filters.threshold_local
+    return (window_size - 1) / 6
+
+def gaussian_kernel(window_size: int) -> np.ndarray:  # нормированное ядро как в scipy.ndimage.gaussian_filter
+    sigma = gaussian_sigma(window_size)
+    radius = int(GAUSSIAN_TRUNCATE * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 / (sigma * sigma) * x * x)
+    return kernel / kernel.sum()
+
+def numpy_gaussian(strip: np.ndarray, halo: int, window_size: int, k: float, params: dict):
+    # T = взвешенное по Гауссу среднее - k: разделимая свертка блоками строк, сначала по столбцам, затем по строкам
+    kernel = gaussian_kernel(window_size)
+    height, width = len(strip) - 2 * halo, strip.shape[1]
+    for start in range(0, height, ROWS_PER_BLOCK):
+        stop = min(start + ROWS_PER_BLOCK, height)
+        rows = strip[start:stop + 2 * halo].astype(np.float64)
+        vertical = np.zeros((stop - start, width))
+        scratch = np.empty_like(vertical)
+        for i, weight in enumerate(kernel):
+            vertical += np.multiply(rows[i:i + stop - start], weight, out=scratch)
+        del rows
+        padded = np.pad(vertical, ((0, 0), (halo, halo)), mode="reflect")
+        threshold = vertical
+        threshold.fill(0)
+        for i, weight in enumerate(kernel):
+            threshold += np.multiply(padded[:, i:i + width], weight, out=scratch)
+        threshold -= k
+        yield start, threshold
+
+def opencv_gaussian(strip: np.ndarray, halo: int, window_size: int, k: float, params: dict):
+    # в float64: для uint8 OpenCV считает свертку в фиксированной точке и округляет
+    size = 2 * halo + 1
+    sigma = gaussian_sigma(window_size)
+    threshold = cv2.GaussianBlur(strip.astype(np.float64), (size, size), sigma, sigmaY=sigma,
+                                 borderType=cv2.BORDER_REFLECT_101)
+    threshold -= k
+    yield 0, threshold[halo:len(strip) - halo]
+
+def skimage_threshold(algorithm: str):
+    def threshold(strip: np.ndarray, halo: int, window_size: int, k: float, params: dict):
+        if algorithm == "niblack":
+            result = filters.threshold_niblack(strip, window_size=window_size, k=k)
+        elif algorithm == "sauvola":
+            result = filters.threshold_sauvola(strip, window_size=window_size, k=k, r=SAUVOLA_R)
+        else:
+            result = filters.threshold_local(strip, window_size, "gaussian", offset=k, mode="mirror",
+                                             param=gaussian_sigma(window_size))
+        yield 0, result[halo:len(strip) - halo]
+    return threshold
+
+def otsu_from_histogram(counts: np.ndarray) -> float:
+    # порог, максимизирующий межклассовую дисперсию, по гистограмме от наименьшей до наибольшей яркости, как в skimage
+    levels = np.flatnonzero(counts)
+    counts = counts[levels[0]:levels[-1] + 1].astype(np.float64)
+    centers = np.arange(levels[0], levels[-1] + 1, dtype=np.float64)
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * centers) / weight1
+    mean2 = (np.cumsum((counts * centers)[::-1]) / weight2[::-1])[::-1]
+    variance = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return float(centers[np.argmax(variance)])
+
+def numpy_otsu(image: np.ndarray) -> float:
+    return otsu_from_histogram(np.bincount(image.ravel(), minlength=256))
+
+def opencv_otsu(image: np.ndarray) -> float:
+    threshold, _ = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return float(threshold)
+
+def skimage_otsu(image: np.ndarray) -> float:
+    return float(filters.threshold_otsu(image))
+
+for name in ("niblack", "sauvola", "wolf"):
+    BACKENDS[name]["numpy"] = (statistics_threshold(numpy_statistics, name), integral_memory)
+BACKENDS["gaussian"]["numpy"] = (numpy_gaussian, gaussian_memory)
+BACKENDS["otsu"]["numpy"] = (numpy_otsu, compare_memory)
+if cv2 is not None:
+    for name in ("niblack", "sauvola", "wolf"):
+        BACKENDS[name]["opencv"] = (statistics_threshold(opencv_statistics, name), array_memory(32))
+    BACKENDS["gaussian"]["opencv"] = (opencv_gaussian, array_memory(24))
+    BACKENDS["otsu"]["opencv"] = (opencv_otsu, compare_memory)
+if filters is not None:  # в skimage нет порога Вульфа
+    for name in ("niblack", "sauvola", "gaussian"):
+        BACKENDS[name]["skimage"] = (skimage_threshold(name), array_memory(64))
+    BACKENDS["otsu"]["skimage"] = (skimage_otsu, compare_memory)
+
+def validate_algorithm(algorithm: str) -> str:
+    algorithm = algorithm.lower()
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unsupported algorithm: {algorithm}. Supported algorithms: {', '.join(ALGORITHMS)}")
+    return algorithm
+
+def available_backends(algorithm: str) -> list:
+    return [name for name in BACKEND_ORDER if name in BACKENDS[algorithm]]
+
+def size_bucket(pixels: int) -> int:
+    return bisect.bisect_left(SIZE_BUCKETS, pixels)
+
+def load_profile(path: str) -> dict:  # выбор бэкендов из профиля калибровки; без профиля - пустой
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to read backend profile {path}: {e}")
+        return {}
+    if profile.get("buckets") != list(SIZE_BUCKETS):
+        logger.warning(f"Backend profile {path} was calibrated for other size buckets, ignoring it")
+        return {}
+    return profile.get("backends", {})
+
+def select_backend(algorithm: str, pixels: int) -> str:  # самый быстрый бэкенд для изображения такого размера
+    global profile_choices
+    if profile_choices is None:
+        profile_choices = load_profile(settings.BACKEND_PROFILE)
+    choices = profile_choices.get(algorithm)
+    if choices and len(choices) > size_bucket(pixels) and choices[size_bucket(pixels)] in BACKENDS[algorithm]:
+        return choices[size_bucket(pixels)]
+    return available_backends(algorithm)[0]
+
+def global_threshold(func, image: np.ndarray) -> float:
+    if image.min() == image.max():  # у однотонного изображения бэкенды расходятся; порог - сама яркость, как в skimage
+        return float(image.flat[0])
+    return func(image)
+
+def wolf_params(backend: str, minimum: int, strips, halo: int, window_size: int) -> dict:
+    # наибольшее отклонение по изображению - отдельный проход по полосам перед вычислением порога
+    max_std = 0.0
+    for strip in strips:
+        for _, _, std in STATISTICS[backend](strip, halo, window_size):
+            max_std = max(max_std, float(std.max()))
+    return {"minimum": float(minimum), "max_std": max_std}
+
+def threshold_image(image: np.ndarray, algorithm: str, window_size: int = 15, k: float = 0.2,
+                    backend: str | None = None):
+    # порог изображения в памяти целиком заданным бэкендом: для калибровки и сравнения бэкендов;
+    # у глобальных алгоритмов - число, у локальных - массив порогов
+    backend = backend or select_backend(algorithm, image.size)
+    func, _ = BACKENDS[algorithm][backend]
+    if algorithm in GLOBAL_ALGORITHMS:
+        return global_threshold(func, image)
+    halo = algorithm_halo(algorithm, window_size)
+    strip = np.pad(image, ((halo, halo), (0, 0)), mode="reflect")
+    params = wolf_params(backend, image.min(), [strip], halo, window_size) if algorithm == "wolf" else {}
+    threshold = np.empty(image.shape, dtype=np.float64)
+    for start, block in func(strip, halo, window_size, k, params):
+        threshold[start:start + len(block)] = block
+    return threshold
+
+def calibrate(sizes=CALIBRATION_SIZES, window_size: int = 15, k: float = 0.2, repeat: int = 3) -> dict:
+    # лучшее время каждого бэкенда на изображении каждой корзины; в профиль попадает самый быстрый
+    if len(sizes) != len(SIZE_BUCKETS) + 1:
+        raise ValueError(f"Calibration needs {len(SIZE_BUCKETS) + 1} image sizes, one per size bucket")
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, size, dtype=np.uint8) for size in sizes]
+    profile = {"buckets": list(SIZE_BUCKETS), "sizes": [list(size) for size in sizes], "window_size": window_size,
+               "backends": {}, "seconds": {}}
+    for algorithm in ALGORITHMS:
+        profile["backends"][algorithm], profile["seconds"][algorithm] = [], []
+        for image in images:
+            timings = {}
+            for backend in available_backends(algorithm):
+                best = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    threshold_image(image, algorithm, window_size, k, backend)
+                    best = min(best, time.perf_counter() - start)
+                timings[backend] = round(best, 6)
+            profile["backends"][algorithm].append(min(timings, key=timings.get))
+            profile["seconds"][algorithm].append(timings)
+    return profile
+
+def save_profile(profile: dict, path: str):
+    global profile_choices
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".json", delete=False) as f:
+        json.dump(profile, f, indent=4)
+    os.replace(f.name, path)  # процессы пула не прочитают недописанный профиль
+    profile_choices = None
+
+def ensure_profile():  # калибровка при запуске сервера, если она включена и профиля еще нет
+    if settings.BACKEND_CALIBRATE and not os.path.exists(settings.BACKEND_PROFILE):
+        logger.info("Calibrating binarization backends")
+        save_profile(calibrate(), settings.BACKEND_PROFILE)
+        logger.info(f"Backend profile saved to {settings.BACKEND_PROFILE}")
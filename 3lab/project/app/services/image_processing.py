@@ -1,60 +1,195 @@
 
-import base64
+import binascii
+import os
+import tempfile
 from io import BytesIO
 from PIL import Image
 import numpy as np
-from skimage import filters
 import logging
+from app.core.config import settings
+from app.services.tiling import ImageTooLarge, iter_mask_strips, plan_strips, write_bilevel_png
+from app.services.result_cache import result_cache, cache_key
+from app.services.backends import validate_algorithm
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def binarize_image(image_base64: str, algorithm: str = "niblack") -> str:
+Image.MAX_IMAGE_PIXELS = settings.MAX_IMAGE_PIXELS  # PIL сам отказывает изображениям вдвое больше предела
+
+# двухуровневые форматы результата: имя -> (формат PIL, параметры сохранения, MIME-тип)
+OUTPUT_FORMATS = {
+    "png": ("PNG", {}, "image/png"),  # PNG с 1 битом на пиксель
+    "tiff": ("TIFF", {"compression": "group4"}, "image/tiff"),  # TIFF со сжатием CCITT Group 4, как у факсов и сканеров
+}
+
+def encode_bilevel(image: Image.Image, output_format: str = "png") -> bytes:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    pil_format, save_options, _ = OUTPUT_FORMATS[output_format]
+    buffered = BytesIO()
+    image.save(buffered, format=pil_format, **save_options)
+    return buffered.getvalue()
+
+def open_image(source) -> Image.Image:
+    # PIL читает только заголовок: размеры и режим известны до декодирования
     try:
-        # отладочный вывод длины входной строки
-        logger.info(f"Received image_base64 length: {len(image_base64)}")
-
-        # удаляем префикс data:image/jpeg;base64, если он есть
-        if image_base64.startswith("data:image"):
-            image_base64 = image_base64.split(",")[1]
-
-        # удаляем пробелы и переносы строк
-        image_base64 = image_base64.strip()
-        if not image_base64:
-            raise ValueError("Пустая строка base64 после обработки")
-
-        # проверяем валидность длины base64 (должна быть кратна 4)
-        if len(image_base64) % 4 != 0:
-            logger.info(f"Invalid base64 length: {len(image_base64)}. Attempting to fix padding...")
-            missing_padding = (4 - len(image_base64) % 4) % 4
-            image_base64 += "=" * missing_padding
-        logger.info(f"Processed image_base64 length after padding: {len(image_base64)}")
-
-        # декодируем base64 в бинарные данные
-        try:
-            image_data = base64.b64decode(image_base64, validate=True)
-        except base64.binascii.Error as e:
-            raise ValueError(f"Ошибка декодирования base64: {str(e)}")
-        logger.info(f"Decoded image_data length: {len(image_data)}")
+        return Image.open(source if isinstance(source, str) else BytesIO(source))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+
+def decode_memory(image: Image.Image) -> int:
+    # пик памяти декодирования: JPEG в цвете декодируется сразу в яркость, остальные - в свой режим и копию в L
+    pixels = image.size[0] * image.size[1]
+    if image.mode == "L" or (image.format == "JPEG" and image.mode == "RGB"):
+        return pixels
+    return pixels * (1 if image.mode in ("1", "P") else 4) + pixels  # PIL хранит многоканальные пиксели в 4 байтах
+
+def check_image(image: Image.Image, algorithm: str, window_size: int):
+    # отказ по размерам из заголовка, пока изображение не декодировано
+    width, height = image.size
+    if width * height > settings.MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"Image {width}x{height} has more than {settings.MAX_IMAGE_PIXELS} pixels")
+    if decode_memory(image) > settings.BINARIZATION_MEMORY_BUDGET:
+        raise ImageTooLarge(f"Decoding image {width}x{height} ({image.mode}) does not fit into the memory budget "
+                            f"of {settings.BINARIZATION_MEMORY_BUDGET} bytes")
+    plan_strips(width, height, algorithm, window_size, settings.BINARIZATION_MEMORY_BUDGET)
+
+def check_image_size(source, algorithm: str = "niblack", window_size: int = 15):
+    # та же проверка для байтов или файла до отправки в процесс пула
+    with open_image(source) as image:
+        check_image(image, validate_algorithm(algorithm), window_size)
+
+def load_grayscale(image: Image.Image) -> Image.Image:
+    # декодирование сразу в оттенки серого: цветной JPEG - яркостью из декодера без промежуточного RGB,
+    # одноканальное изображение - без копии
+    if image.format == "JPEG" and image.mode == "RGB":
+        image.draft("L", None)
+    if image.mode == "L":
+        image.load()
+        return image
+    return image.convert("L")
+
+def binarize_stream(source, out, algorithm: str = "niblack", output_format: str = "png",
+                    window_size: int = 15, k: float = 0.2):
+    # бинаризация изображения (байты файла или путь к нему) с записью результата в out;
+    # порог считается полосами в пределах BINARIZATION_MEMORY_BUDGET самым быстрым для такого размера бэкендом,
+    # маска хранится упакованной по 8 пикселей в байте
+    algorithm = validate_algorithm(algorithm)
+    if output_format not in OUTPUT_FORMATS:  # проверяем до декодирования и пороговой обработки
+        raise ValueError(f"Unsupported output format: {output_format}")
+    image = open_image(source)
+    try:
+        check_image(image, algorithm, window_size)
+        gray = load_grayscale(image)
+    except Exception:
+        image.close()
+        raise
+    if gray is not image:  # исходное изображение освобождается до порога: бюджет памяти учитывает только L и полосу
+        image.close()
+    width, height = gray.size
+    packed_strips = (np.packbits(mask, axis=1)
+                     for _, mask in iter_mask_strips(gray, algorithm, window_size, k,
+                                                        settings.BINARIZATION_MEMORY_BUDGET))
+    if output_format == "png":  # PNG пишется по мере готовности полос
+        write_bilevel_png(out, width, height, packed_strips)
+        return
+    packed = b"".join(strip.tobytes() for strip in packed_strips)  # изображение режима "1" из упакованных строк
+    out.write(encode_bilevel(Image.frombytes("1", (width, height), packed), output_format))
+
+def binarize_to_file(image_data: bytes, algorithm: str = "niblack", output_format: str = "png",
+                     window_size: int = 15, k: float = 0.2) -> bytes:
+    # бинаризация изображения из байтов файла; функция верхнего уровня, чтобы ее можно было передать в процесс пула
+    buffered = BytesIO()
+    binarize_stream(image_data, buffered, algorithm, output_format, window_size, k)
+    return buffered.getvalue()
 
-        image = Image.open(BytesIO(image_data)).convert("L")
-        img_array = np.array(image)
+def binarize_to_path(source, algorithm: str = "niblack", output_format: str = "png",
+                     window_size: int = 15, k: float = 0.2) -> str:
+    # то же для больших изображений: результат пишется во временный файл, вызывающий удаляет его после отправки
+    with tempfile.NamedTemporaryFile(dir=settings.SPOOL_DIR, suffix=f".{output_format}", delete=False) as out:
+        try:
+            binarize_stream(source, out, algorithm, output_format, window_size, k)
+        except Exception:
+            out.close()
+            os.unlink(out.name)
+            raise
+    return out.name
 
-        if algorithm.lower() != "niblack":
-            raise ValueError("Only 'niblack' algorithm is supported")
+def binarize_cached(image_data: bytes, algorithm: str = "niblack", output_format: str = "png",
+                    window_size: int = 15, k: float = 0.2) -> bytes:
+    # результат из кеша по хешу изображения и параметров, иначе бинаризация и сохранение в кеш
+    key = cache_key(image_data, algorithm, output_format, window_size, k)
+    result = result_cache.get(key)
+    if result is None:
+        result = binarize_to_file(image_data, algorithm, output_format, window_size, k)
+        result_cache.put(key, result)
+    return result
 
-        threshold = filters.threshold_niblack(img_array)
-        binarized_array = img_array > threshold
-        binarized_image = Image.fromarray(binarized_array.astype(np.uint8) * 255)
+BASE64_WHITESPACE = frozenset(b" \t\r\n")  # допустимые пробелы по краям строки base64
 
-        # кодируем результат обратно в base64
-        buffered = BytesIO()
-        binarized_image.save(buffered, format="PNG")
-        binarized_image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        logger.info(f"Output base64 length: {len(binarized_image_base64)}")
-        return binarized_image_base64
+def base64_view(image_base64):
+    # base64 без префикса data:...;base64, и пробелов по краям: строка как есть, если обрезать нечего,
+    # иначе срез memoryview одной ASCII-копии строки
+    if isinstance(image_base64, str):
+        if not image_base64.isascii():
+            raise ValueError("Ошибка декодирования base64: строка содержит символы не из ASCII")
+        if not (image_base64.startswith("data:") or image_base64[:1].isspace() or image_base64[-1:].isspace()
+                or len(image_base64) % 4):
+            return image_base64  # a2b_base64 принимает ASCII-строку без копирования
+        image_base64 = image_base64.encode("ascii")
+    view = memoryview(image_base64).cast("B")
+    start, end = 0, len(view)
+    if view[:5] == b"data:":
+        start = bytes(view[:256]).find(b",") + 1  # заголовок data:image/...;base64, короткий
+        if not start:
+            raise ValueError("Некорректный префикс data: в строке base64")
+    while start < end and view[start] in BASE64_WHITESPACE:
+        start += 1
+    while end > start and view[end - 1] in BASE64_WHITESPACE:
+        end -= 1
+    return view[start:end]
 
-    except base64.binascii.Error as e:
+def decode_base64_image(image_base64) -> bytes:
+    # единственное декодирование и проверка base64 для HTTP, WebSocket и Celery: строгий a2b_base64 проверяет алфавит
+    # и дополнение за один проход по строке; результат - один буфер bytes, который дальше передается без копий
+    # (хеш кеша, BytesIO для PIL, процесс пула)
+    data = base64_view(image_base64)
+    if not len(data):
+        raise ValueError("Пустая строка base64 после обработки")
+    tail = len(data) % 4
+    try:
+        if not tail:
+            image_data = binascii.a2b_base64(data, strict_mode=True)
+        else:  # без дополнения "=": декодируем кратную 4 часть и дополненный хвост из 2-3 символов
+            logger.info(f"Invalid base64 length: {len(data)}. Fixing padding")
+            image_data = binascii.a2b_base64(data[:len(data) - tail], strict_mode=True) + \
+                binascii.a2b_base64(bytes(data[len(data) - tail:]) + b"=" * (4 - tail), strict_mode=True)
+    except ValueError as e:  # binascii.Error
         raise ValueError(f"Ошибка декодирования base64: {str(e)}")
+    logger.info(f"Decoded {len(image_base64)} base64 characters into {len(image_data)} bytes")
+    return image_data
+
+def encode_base64(data) -> str:  # результат для JSON-ответов и сообщений
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+def spool_image(image_data: bytes) -> str:
+    # проверенные байты изображения во временный файл для задачи Celery: брокер передает JSON, а не bytes,
+    # и задача получает путь вместо base64, который пришлось бы декодировать и проверять второй раз
+    with tempfile.NamedTemporaryFile(dir=settings.SPOOL_DIR, suffix=".image", delete=False) as spool:
+        spool.write(image_data)
+    return spool.name
+
+def binarize_spooled(path: str, algorithm: str = "niblack", output_format: str = "png",
+                     window_size: int = 15, k: float = 0.2) -> str:
+    # путь задачи Celery: байты из spool_image -> результат в base64; временный файл удаляется после чтения
+    try:
+        with open(path, "rb") as f:
+            image_data = f.read()
+    finally:
+        os.unlink(path)
+    try:
+        return encode_base64(binarize_cached(image_data, algorithm, output_format, window_size, k))
+    except ValueError:  # ошибки base64 и ImageTooLarge (эндпоинты отвечают на нее 413) - как есть
+        raise
     except Exception as e:
-        raise ValueError(f"Ошибка при обработке изображения: {str(e)}")
\ No newline at end of file
+        raise ValueError(f"Ошибка при обработке изображения: {str(e)}")
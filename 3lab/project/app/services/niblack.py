@@ -0,0 +1,102 @@
+import numpy as np
+
+ROWS_PER_BLOCK = 256  # сколько строк порога считается за раз: временные массивы float64 не растут с размером изображения
+
+def validate_window(window_size: int, k: float):
+    if not isinstance(window_size, int) or window_size < 3 or window_size % 2 == 0:
+        raise ValueError("window_size must be an odd integer >= 3")
+    if not np.isfinite(k):
+        raise ValueError("k must be a finite number")
+
+def table_dtype(image: np.ndarray, window_size: int):
+    # таблицы считаются по модулю 2^32 (2^64): переполнение в углах таблицы не мешает, пока сумма одного окна
+    # помещается в тип, поэтому для uint8 и окон до 257 хватает 4 байт на пиксель вместо 8
+    max_value = int(np.iinfo(image.dtype).max)
+    return np.uint32 if window_size * window_size * max_value * max_value < 2 ** 32 else np.uint64
+
+def padding(window_size: int) -> tuple[int, int]:
+    # отступ как в skimage: сверху и слева на строку больше, чтобы сумма окна считалась по четырем углам таблицы
+    return window_size // 2 + 1, window_size // 2
+
+def reflect_indices(indices: np.ndarray, size: int) -> np.ndarray:
+    # номера строк за краем изображения -> номера отраженных строк, как np.pad(mode="reflect"), в том числе при отступе больше размера
+    if size == 1:
+        return np.zeros_like(indices)
+    period = 2 * (size - 1)
+    indices = np.abs(indices) % period
+    return np.where(indices >= size, period - indices, indices)
+
+def integral_images(padded: np.ndarray, dtype):
+    # таблицы сумм яркостей и квадратов яркостей по изображению, дополненному отражением
+    sums = np.cumsum(padded, axis=0, dtype=dtype)
+    np.cumsum(sums, axis=1, out=sums)
+    squares = padded.astype(np.uint16 if padded.dtype == np.uint8 else dtype)
+    squares *= squares  # 255 * 255 помещается в uint16
+    del padded
+    squares_sums = np.cumsum(squares, axis=0, dtype=dtype)
+    del squares
+    np.cumsum(squares_sums, axis=1, out=squares_sums)
+    return sums, squares_sums
+
+def window_sums(table: np.ndarray, window_size: int, start: int, stop: int) -> np.ndarray:
+    # суммы по окнам для строк start..stop исходного изображения: четыре обращения к таблице на пиксель
+    w = window_size
+    return (table[start + w:stop + w, w:] - table[start:stop, w:]
+            - table[start + w:stop + w, :-w] + table[start:stop, :-w])
+
+def validate_image(image: np.ndarray):
+    if image.ndim != 2:
+        raise ValueError("Niblack expects a grayscale image")
+    if not np.issubdtype(image.dtype, np.integer):
+        raise ValueError("Niblack expects an integer grayscale image")
+
+def iter_thresholds(image: np.ndarray, window_size: int = 15, k: float = 0.2):
+    # порог Niblack T = m - k * s блоками строк: (начальная строка, порог блока)
+    validate_window(window_size, k)
+    validate_image(image)
+    before, after = padding(window_size)
+    # дополненное изображение не держим в этом кадре: его освобождают после построения таблиц
+    yield from iter_padded_thresholds(np.pad(image, ((before, after), (before, after)), mode="reflect"),
+                                      window_size, k, table_dtype(image, window_size))
+
+def iter_padded_statistics(padded: np.ndarray, window_size: int, dtype):
+    # среднее и стандартное отклонение по окну блоками строк для дополненного изображения или полосы
+    # с запасом строк сверху и снизу (см. tiling): (начальная строка, среднее, отклонение)
+    sums, squares_sums = integral_images(padded, dtype)
+    del padded
+    n = window_size * window_size
+    height = sums.shape[0] - window_size
+    for start in range(0, height, ROWS_PER_BLOCK):
+        stop = min(start + ROWS_PER_BLOCK, height)
+        s1 = window_sums(sums, window_size, start, stop).astype(np.int64)
+        s2 = window_sums(squares_sums, window_size, start, stop).astype(np.int64)
+        # дисперсия в целых числах без потери точности: (n * S2 - S1^2) / n^2
+        std = (s2 * n - s1 * s1).astype(np.float64)
+        std /= n * n
+        np.sqrt(std, out=std)
+        mean = s1.astype(np.float64)
+        mean /= n
+        yield start, mean, std
+
+def iter_padded_thresholds(padded: np.ndarray, window_size: int, k: float, dtype):
+    # порог Niblack для уже дополненного изображения или полосы
+    statistics = iter_padded_statistics(padded, window_size, dtype)
+    del padded  # дополненное изображение освобождает генератор после построения таблиц
+    for start, mean, std in statistics:
+        std *= k
+        mean -= std
+        yield start, mean
+
+def threshold_niblack(image: np.ndarray, window_size: int = 15, k: float = 0.2) -> np.ndarray:
+    # локальный порог Niblack за O(пикселей) при любом размере окна; совпадает с skimage.filters.threshold_niblack
+    threshold = np.empty(image.shape, dtype=np.float64)
+    for start, block in iter_thresholds(image, window_size, k):
+        threshold[start:start + len(block)] = block
+    return threshold
+
+def niblack_mask(image: np.ndarray, window_size: int = 15, k: float = 0.2) -> np.ndarray:
+    # маска пикселей ярче порога; полный массив порогов не создается
+    mask = np.empty(image.shape, dtype=bool)
+    for start, block in iter_thresholds(image, window_size, k):
+        np.greater(image[start:start + len(block)], block, out=mask[start:start + len(block)])
+    return mask
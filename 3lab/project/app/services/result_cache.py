@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# версия пути бинаризации (алгоритмы, бэкенды, кодирование результата) в ключе кеша: увеличивается при любом
+# изменении результата, чтобы файлы, записанные на диск прежней реализацией, больше не находились
+PIPELINE_VERSION = 2
+
+def cache_key(image_data, algorithm: str, output_format: str, window_size: int, k: float) -> str:
+    # адрес результата: хеш байтов изображения, параметров бинаризации и версии пути
+    digest = hashlib.blake2b(image_data, digest_size=20)
+    digest.update(f"|{algorithm.lower()}|{output_format}|{window_size}|{float(k)!r}|v{PIPELINE_VERSION}".encode())
+    return digest.hexdigest()
+
+class ResultCache:  # результаты бинаризации: LRU в памяти процесса и общий для процессов каталог на диске
+    def __init__(self, memory_bytes: int, disk_dir: str | None, disk_bytes: int):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir if disk_bytes > 0 else None
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()  # ключ -> результат, от давно использованных к недавним
+        self.size = 0
+        self.disk_size = None  # считается при первой записи на диск
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return data
+        data = self.read_disk(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put_memory(key, data)  # повторные обращения не читают диск
+        return data
+
+    def put(self, key: str, data: bytes):
+        self.put_memory(key, data)
+        self.write_disk(key, data)
+
+    def put_memory(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes // 4:  # один большой результат не вытесняет весь кеш
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.memory_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def read_disk(self, key: str) -> bytes | None:
+        if self.disk_dir is None:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # время изменения файла - время последнего использования для вытеснения
+            return data
+        except OSError:
+            return None
+
+    def write_disk(self, key: str, data: bytes):
+        if self.disk_dir is None or len(data) > self.disk_bytes // 4:
+            return
+        path = self.path(key)
+        try:
+            old_size = os.stat(path).st_size  # перезапись того же ключа не увеличивает размер кеша
+        except OSError:
+            old_size = 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # запись во временный файл и переименование: другие процессы не прочитают недописанный результат
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+        except OSError as e:
+            logger.warning(f"Failed to write result cache entry {key}: {e}")
+            return
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, _, size in self.disk_files())
+            else:
+                self.disk_size += len(data) - old_size
+            if self.disk_size <= self.disk_bytes:
+                return
+        self.evict_disk()
+
+    def disk_files(self):  # (время использования, путь, размер) файлов дискового кеша
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:  # файл удалил другой процесс
+                    continue
+                yield st.st_mtime, os.path.join(root, name), st.st_size
+
+    def evict_disk(self):  # удаление давно использованных файлов до 90% предела, чтобы не вытеснять на каждой записи
+        files = sorted(self.disk_files())
+        total = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if total <= self.disk_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        with self.lock:
+            self.disk_size = total
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.memory_hits + self.disk_hits + self.misses
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": round((self.memory_hits + self.disk_hits) / requests, 4) if requests else None,
+                    "memory_entries": len(self.entries), "memory_bytes": self.size, "disk_bytes": self.disk_size}
+
+result_cache = ResultCache(settings.RESULT_CACHE_MEMORY, settings.RESULT_CACHE_DIR, settings.RESULT_CACHE_DISK)
@@ -0,0 +1,90 @@
+import struct
+import zlib
+import numpy as np
+from PIL import Image
+from app.services.niblack import reflect_indices, validate_window
+from app.services.backends import (BACKENDS, GLOBAL_ALGORITHMS, algorithm_halo, global_threshold, select_backend,
+                                   wolf_params)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESS_LEVEL = 6  # как у PIL по умолчанию
+
+class ImageTooLarge(ValueError):  # изображение не помещается в бюджет памяти
+    pass
+
+def rows_per_strip(height: int, width: int, window_size: int, halo: int, memory, budget: int, reserved: int = 0) -> int:
+    # сколько строк обрабатывать за раз, чтобы декодированное изображение и полоса уложились в budget байт;
+    # memory - оценка пика памяти бэкенда на полосу, reserved - память сверх полосы
+    available = budget - height * width - reserved  # декодированное изображение в режиме L хранится целиком
+    if available < memory(1, width, window_size, halo):
+        raise ImageTooLarge(f"Image {width}x{height} does not fit into the memory budget of {budget} bytes")
+    low, high = 1, height
+    while low < high:  # наибольшее число строк в пределах бюджета
+        middle = (low + high + 1) // 2
+        if memory(middle, width, window_size, halo) <= available:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def iter_strips(image: Image.Image, rows: int, halo: int):
+    # (начальная строка, полоса) по rows строк с запасом halo строк сверху и снизу, отраженных у краев изображения
+    width, height = image.size
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        indices = reflect_indices(np.arange(start - halo, stop + halo), height)
+        low, high = int(indices.min()), int(indices.max()) + 1
+        region = np.asarray(image.crop((0, low, width, high)))  # копируются только нужные строки
+        yield start, region[indices - low]
+
+def plan_strips(width: int, height: int, algorithm: str, window_size: int, budget: int,
+                backend: str | None = None) -> tuple[str, int]:
+    # бэкенд и высота полосы для изображения по одним размерам, до декодирования;
+    # ImageTooLarge, если в бюджет не помещается даже одна строка
+    backend = backend or select_backend(algorithm, width * height)
+    _, memory = BACKENDS[algorithm][backend]
+    if algorithm in GLOBAL_ALGORITHMS:  # копия изображения для глобального порога
+        return backend, rows_per_strip(height, width, window_size, 0, memory, budget, reserved=height * width)
+    return backend, rows_per_strip(height, width, window_size, algorithm_halo(algorithm, window_size), memory, budget)
+
+def iter_mask_strips(image: Image.Image, algorithm: str, window_size: int, k: float, budget: int,
+                     backend: str | None = None):
+    # маска пикселей ярче порога полосами строк: у каждой полосы запас строк на половину окна, поэтому результат
+    # совпадает с обработкой изображения целиком; в памяти одновременно только одна полоса
+    validate_window(window_size, k)
+    width, height = image.size
+    backend, rows = plan_strips(width, height, algorithm, window_size, budget, backend)
+    func, _ = BACKENDS[algorithm][backend]
+    if algorithm in GLOBAL_ALGORITHMS:  # порог по всему изображению, затем только сравнение полос с ним
+        threshold = global_threshold(func, np.asarray(image))
+        for start, strip in iter_strips(image, rows, 0):
+            yield start, strip > threshold
+        return
+    halo = algorithm_halo(algorithm, window_size)
+    params = {}
+    if algorithm == "wolf":  # порогу Вульфа нужны наименьшая яркость и наибольшее отклонение всего изображения
+        params = wolf_params(backend, image.getextrema()[0], (strip for _, strip in iter_strips(image, rows, halo)),
+                             halo, window_size)
+    for start, strip in iter_strips(image, rows, halo):
+        mask = np.empty((len(strip) - 2 * halo, width), dtype=bool)
+        for offset, block in func(strip, halo, window_size, k, params):
+            np.greater(strip[halo + offset:halo + offset + len(block)], block, out=mask[offset:offset + len(block)])
+        del strip
+        yield start, mask
+
+def png_chunk(chunk_type: bytes, data) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+
+def write_bilevel_png(out, width: int, height: int, packed_strips):
+    # PNG с 1 битом на пиксель по мере поступления полос упакованных строк, без сборки всего изображения
+    out.write(PNG_SIGNATURE)
+    out.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)))  # 1 бит, оттенки серого
+    compressor = zlib.compressobj(PNG_COMPRESS_LEVEL)
+    for packed in packed_strips:
+        rows = np.zeros((packed.shape[0], packed.shape[1] + 1), dtype=np.uint8)  # первый байт строки - фильтр 0
+        rows[:, 1:] = packed
+        data = compressor.compress(rows)
+        if data:
+            out.write(png_chunk(b"IDAT", data))
+    out.write(png_chunk(b"IDAT", compressor.flush()))
+    out.write(png_chunk(b"IEND", b""))
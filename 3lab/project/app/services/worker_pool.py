@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+class PoolBusy(Exception):  # все процессы заняты и очередь заполнена
+    pass
+
+_executor = None
+_in_flight = 0  # запросы в процессах и в очереди; меняется только в потоке event loop
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:  # процессы создаются при первом запросе, а не при импорте
+        _executor = ProcessPoolExecutor(max_workers=settings.BINARIZATION_WORKERS)
+        logger.info(f"Started binarization pool with {settings.BINARIZATION_WORKERS} workers")
+    return _executor
+
+async def run_in_pool(func, *args):
+    # CPU-работа уходит в процесс, event loop продолжает обслуживать другие запросы и WebSocket
+    global _in_flight
+    if _in_flight >= settings.BINARIZATION_WORKERS + settings.BINARIZATION_QUEUE_DEPTH:
+        raise PoolBusy()  # быстрый отказ вместо неограниченного роста задержки
+    _in_flight += 1
+    executor = get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        # процесс пула убит (например, OOM на большом скане): сломанный пул заменяется новым при следующем запросе
+        logger.warning("Binarization pool is broken, restarting it")
+        drop_executor(executor)
+        raise PoolBusy()
+    finally:
+        _in_flight -= 1
+
+def drop_executor(executor: ProcessPoolExecutor):
+    global _executor
+    if _executor is executor:  # пул мог уже заменить другой запрос
+        _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
@@ -1,21 +1,24 @@
 from app.celery_config import celery_app
 from celery import shared_task
-from app.services.image_processing import binarize_image
+from app.services.image_processing import binarize_spooled
 import logging
+import os
 import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 @shared_task(bind=True)
-def process_image_task(self, image: str, algorithm: str = "niblack", token: str = None):
-    logger.info(f"Received image: {image[:50]}... (length: {len(image)})")
+def process_image_task(self, image_path: str, algorithm: str = "niblack", token: str = None, output_format: str = "png",
+                       window_size: int = 15, k: float = 0.2):
+    # image_path - байты изображения, уже проверенные обработчиком WebSocket (spool_image)
+    logger.info(f"Received image: {image_path} ({os.path.getsize(image_path)} bytes)")
     
     for progress in range(0, 101, 20):
         time.sleep(1) 
         self.update_state(state='PROGRESS', meta={'progress': progress})
     
-    result = binarize_image(image, algorithm)
+    result = binarize_spooled(image_path, algorithm, output_format, window_size, k)
     
     self.update_state(state='COMPLETED', meta={'binarized_image': result})
     
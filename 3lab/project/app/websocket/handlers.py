@@ -5,7 +5,11 @@ from app.celery_config import celery_app
 from app.tasks import process_image_task
 from celery.result import AsyncResult
 import asyncio
+import uuid
+from fastapi.concurrency import run_in_threadpool
 from starlette.websockets import WebSocketDisconnect  
+from app.services.image_processing import decode_base64_image, encode_base64, spool_image
+from app.services.result_cache import result_cache, cache_key
 
 logger = logging.getLogger(__name__)
 active_connections = {}
@@ -27,10 +31,29 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
             if action == "binarize_image":
                 image = data.get("image")
                 algorithm = data.get("algorithm", "niblack")
+                output_format = data.get("output_format", "png")  # png или tiff (CCITT Group 4)
+                window_size = data.get("window_size", 15)  # параметры Niblack
+                k = data.get("k", 0.2)
                 logger.info(f"Processing binarize_image with algorithm: {algorithm}, image length: {len(image)}")
+
+                try:
+                    image_data = await run_in_threadpool(decode_base64_image, image)
+                except ValueError as e:  # base64 проверяется только здесь: с ошибкой задача Celery не создается
+                    await websocket.send_json({"error": str(e)})
+                    continue
+                cached = await cached_result(image_data, algorithm, output_format, window_size, k)
+                if cached is not None:  # результат уже есть: без задачи Celery
+                    task_id = str(uuid.uuid4())
+                    await websocket.send_json({"status": "STARTED", "task_id": task_id, "algorithm": algorithm})
+                    await websocket.send_json({"status": "COMPLETED", "task_id": task_id,
+                                               "binarized_image": encode_base64(cached)})
+                    logger.info(f"Sent cached result for task {task_id}")
+                    continue
                 
                 from app.tasks import process_image_task
-                task = process_image_task.delay(image, algorithm, token=token)
+                image_path = await run_in_threadpool(spool_image, image_data)  # задаче - байты, а не base64 еще раз
+                task = process_image_task.delay(image_path, algorithm, token=token, output_format=output_format,
+                                                window_size=window_size, k=k)
                 logger.info(f"Task sent to Celery: {task.id}")
                 
                 start_message = {
@@ -61,6 +84,10 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
             except Exception as e:
                 logger.warning(f"Error closing WebSocket (ignored): {str(e)}")
 
+async def cached_result(image_data: bytes, algorithm: str, output_format: str, window_size: int, k: float):
+    key = await run_in_threadpool(cache_key, image_data, algorithm, output_format, window_size, k)
+    return await run_in_threadpool(result_cache.get, key)
+
 async def monitor_task_progress(task_id: str, websocket: WebSocket, token: str):
     result = AsyncResult(task_id, app=celery_app)
     last_progress = -1
@@ -0,0 +1,77 @@
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from PIL import Image
+from app.services.backends import (ALGORITHMS, BACKENDS, GLOBAL_ALGORITHMS, algorithm_halo, available_backends,
+                                   threshold_image, calibrate, save_profile)
+from app.services.tiling import iter_mask_strips
+from benchmarks.synthetic import make_document, parse_size
+
+# совпадение бэкендов бинаризации с numpy в пределах допуска, в том числе при обработке полосами, и их время;
+# с --profile результаты калибровки сохраняются как профиль выбора бэкендов
+# запуск из директории project: python -m benchmarks.backends
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+def compare(image: np.ndarray, reference, threshold, tolerance: float) -> dict:
+    # расхождение порогов и число пикселей в разных классах; пиксели у самого порога могут разойтись из-за округления
+    max_diff = float(np.abs(np.asarray(reference, dtype=np.float64) - threshold).max())
+    mismatched = int(((image > reference) != (image > threshold)).sum())
+    near_threshold = int((np.abs(image - np.asarray(reference)) <= tolerance).sum())
+    return {"max_threshold_diff": max_diff, "mismatched_pixels": mismatched,
+            "passed": max_diff <= tolerance and mismatched <= near_threshold}
+
+def strips_mask(image: np.ndarray, algorithm: str, window_size: int, k: float, backend: str, rows: int) -> np.ndarray:
+    # маска через полосы: бюджет памяти подобран так, чтобы в полосу помещалось rows строк
+    pil_image = Image.fromarray(image)
+    memory = BACKENDS[algorithm][backend][1]
+    budget = image.size * (2 if algorithm in GLOBAL_ALGORITHMS else 1) + \
+        memory(rows, image.shape[1], window_size, algorithm_halo(algorithm, window_size))
+    mask = np.empty(image.shape, dtype=bool)
+    for start, strip in iter_mask_strips(pil_image, algorithm, window_size, k, budget, backend):
+        mask[start:start + len(strip)] = strip
+    return mask
+
+def main():
+    parser = argparse.ArgumentParser(description="Бэкенды бинаризации: совпадение и время")
+    parser.add_argument("--sizes", nargs="+", default=["300x200", "1024x1024", "2048x2048"])
+    parser.add_argument("--algorithms", nargs="+", default=list(ALGORITHMS), choices=ALGORITHMS)
+    parser.add_argument("--window-sizes", nargs="+", type=int, default=[15, 51])
+    parser.add_argument("--k", type=float, default=0.2)
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="допустимое расхождение порогов")
+    parser.add_argument("--strip-rows", type=int, default=100, help="примерная высота полосы при проверке полосами")
+    parser.add_argument("--profile", help="откалибровать бэкенды и сохранить профиль в этот файл")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов замера при калибровке")
+    args = parser.parse_args()
+
+    results, ok = [], True
+    for size in args.sizes:
+        image = make_document(*parse_size(size))
+        for algorithm in args.algorithms:
+            window_sizes = args.window_sizes[:1] if algorithm in GLOBAL_ALGORITHMS else args.window_sizes
+            for window_size in window_sizes:
+                reference, _ = timed(lambda: threshold_image(image, algorithm, window_size, args.k, "numpy"))
+                for backend in available_backends(algorithm):
+                    threshold, seconds = timed(lambda: threshold_image(image, algorithm, window_size, args.k, backend))
+                    line = {"size": size, "algorithm": algorithm, "window_size": window_size, "backend": backend,
+                            "seconds": round(seconds, 4), **compare(image, reference, threshold, args.tolerance)}
+                    mask = strips_mask(image, algorithm, window_size, args.k, backend, args.strip_rows)
+                    line["strips_mismatched_pixels"] = int((mask != (image > threshold)).sum())
+                    line["passed"] = line["passed"] and line["strips_mismatched_pixels"] == 0
+                    ok = ok and line["passed"]
+                    results.append(line)
+    output = {"equivalence": results}
+    if args.profile:
+        profile = calibrate(repeat=args.repeat)
+        save_profile(profile, args.profile)
+        output["profile"] = profile
+    print(json.dumps(output, indent=4))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from app.services.image_processing import open_image, check_image, load_grayscale
+from app.services.tiling import ImageTooLarge, write_bilevel_png
+from benchmarks.synthetic import make_document, parse_size
+
+# декодирование в оттенки серого: прежний путь Image.open().convert("L") против чтения заголовка и декодирования
+# сразу в яркость; каждый замер - в отдельном процессе, чтобы пик RSS относился только к нему
+# запуск из директории project: python -m benchmarks.decode
+
+METHODS = ("convert", "grayscale")
+FORMATS = ("jpeg-rgb", "png-rgb", "png-l")
+
+def proc_status_kb(field: str) -> int:  # поле /proc/self/status в КБ (только Linux)
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+def decode(method: str, data: bytes) -> Image.Image:
+    if method == "convert":
+        return Image.open(BytesIO(data)).convert("L")
+    image = open_image(data)
+    check_image(image, "niblack", 15)
+    return load_grayscale(image)
+
+def run_child(method: str, path: str):  # замер в этом процессе: время и прирост пика RSS при декодировании
+    with open(path, "rb") as f:
+        data = f.read()
+    before = proc_status_kb("VmRSS")
+    start = time.perf_counter()
+    image = decode(method, data)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "peak_rss_kb": proc_status_kb("VmHWM") - before, "mode": image.mode}))
+
+def measure(method: str, path: str, repeat: int) -> dict:  # лучшее время и наименьший пик из repeat процессов
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.decode", "--child", method, path],
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {"seconds": round(min(run["seconds"] for run in runs), 4),
+            "peak_rss_mb": round(min(run["peak_rss_kb"] for run in runs) / 1024, 1)}
+
+def write_sample(path: str, image_format: str, gray: np.ndarray):
+    if image_format == "png-l":
+        Image.fromarray(gray).save(path, "PNG")
+        return
+    tint = np.stack([gray, (gray * 0.9).astype(np.uint8), (gray * 0.8).astype(np.uint8)], axis=2)  # цветной скан
+    if image_format == "jpeg-rgb":
+        Image.fromarray(tint).save(path, "JPEG", quality=90)
+    else:
+        Image.fromarray(tint).save(path, "PNG")
+
+def header_rejection(directory: str, size: int) -> dict:
+    # PNG size x size пикселей из нулевых строк: файл маленький, декодированное изображение огромное
+    path = os.path.join(directory, "bomb.png")
+    with open(path, "wb") as out:
+        row = np.zeros((1, (size + 7) // 8), dtype=np.uint8)
+        write_bilevel_png(out, size, size, (row for _ in range(size)))
+    with open(path, "rb") as f:
+        data = f.read()
+    start = time.perf_counter()
+    try:
+        check_image(open_image(data), "niblack", 15)
+        rejected = False
+    except ImageTooLarge:
+        rejected = True
+    return {"pixels": size * size, "file_bytes": len(data), "rejected": rejected,
+            "seconds": round(time.perf_counter() - start, 6)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Декодирование изображений в оттенки серого: время и пик памяти")
+    parser.add_argument("--sizes", nargs="+", default=["1024x768", "3508x2480", "7016x4960"])
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=FORMATS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--bomb-size", type=int, default=30000, help="сторона изображения для проверки отказа по заголовку")
+    parser.add_argument("--child", nargs=2, metavar=("METHOD", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(*args.child)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            gray = make_document(*parse_size(size))
+            for image_format in args.formats:
+                path = os.path.join(directory, f"{size}.{image_format}")
+                write_sample(path, image_format, gray)
+                line = {"size": size, "format": image_format, "file_bytes": os.path.getsize(path)}
+                for method in METHODS:
+                    line[method] = measure(method, path, args.repeat)
+                with open(path, "rb") as f:
+                    data = f.read()
+                # яркость из декодера JPEG может отличаться от пересчета RGB -> L на единицы округления
+                difference = np.abs(np.asarray(decode("convert", data), dtype=np.int16) -
+                                    np.asarray(decode("grayscale", data), dtype=np.int16))
+                line["max_gray_diff"] = int(difference.max())
+                results.append(line)
+        output = {"decode": results, "header_rejection": header_rejection(directory, args.bomb_size)}
+    print(json.dumps(output, indent=4))
+
+if __name__ == "__main__":
+    main()
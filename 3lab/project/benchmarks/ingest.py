@@ -0,0 +1,64 @@
+import argparse
+import base64
+import json
+import time
+import tracemalloc
+from io import BytesIO
+from PIL import Image
+from starlette.responses import JSONResponse
+from app.api.endpoints.media import image_json
+from app.services.image_processing import decode_base64_image, binarize_to_file
+from benchmarks.synthetic import make_document, parse_size
+
+# профиль выделений памяти на входе и выходе JSON-эндпоинта: прежние декодирование base64 (strip, дополнение,
+# b64decode с validate) и ответ через str и json.dumps против общего пути a2b_base64 и ответа из байтов
+# запуск из директории project: python -m benchmarks.ingest
+
+def legacy_decode(image_base64: str) -> bytes:  # прежний decode_base64_image без журнала
+    if image_base64.startswith("data:image"):
+        image_base64 = image_base64.split(",")[1]
+    image_base64 = image_base64.strip()
+    if len(image_base64) % 4 != 0:
+        image_base64 += "=" * ((4 - len(image_base64) % 4) % 4)
+    return base64.b64decode(image_base64, validate=True)
+
+def legacy_response(result: bytes) -> bytes:  # словарь со строкой base64, который FastAPI сериализует в JSON
+    return JSONResponse({"binarized_image": base64.b64encode(result).decode("utf-8")}).body
+
+def profile(func, *args) -> dict:  # время и пик выделенной Python-памяти сверх уже занятой
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return {"seconds": round(seconds, 5), "peak_mb": round(peak / 2 ** 20, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Выделения памяти при декодировании base64 и ответе JSON")
+    parser.add_argument("--sizes", nargs="+", default=["1024x768", "3508x2480"])
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        buffered = BytesIO()
+        Image.fromarray(make_document(*parse_size(size))).save(buffered, "PNG")
+        image_data = buffered.getvalue()
+        result = binarize_to_file(image_data)
+        clean = base64.b64encode(image_data).decode("ascii")
+        inputs = {"clean": clean, "data_url": "data:image/png;base64," + clean + "\n", "unpadded": clean.rstrip("=")}
+        for name, image_base64 in inputs.items():
+            assert decode_base64_image(image_base64) == image_data == legacy_decode(image_base64)
+            results.append({"size": size, "input": name, "base64_mb": round(len(image_base64) / 2 ** 20, 2),
+                            "decode": {"legacy": profile(legacy_decode, image_base64),
+                                       "shared": profile(decode_base64_image, image_base64)}})
+        assert json.loads(image_json(result).body) == json.loads(legacy_response(result))
+        results.append({"size": size, "result_mb": round(len(result) / 2 ** 20, 2),
+                        "response": {"legacy": profile(legacy_response, result),
+                                     "shared": profile(lambda: image_json(result).body)}})
+    print(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
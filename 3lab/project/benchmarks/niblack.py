@@ -0,0 +1,63 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+from skimage import filters
+from app.services.niblack import threshold_niblack, niblack_mask
+from benchmarks.synthetic import make_document, parse_size
+
+# сравнение движка Niblack на таблицах сумм с skimage.filters.threshold_niblack: совпадение, время, пиковая память
+# запуск из директории project: python -m benchmarks.niblack
+
+def measure(func, repeat: int):  # лучшее время из repeat запусков и пик памяти numpy по tracemalloc
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+        del result
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Niblack: собственный движок против skimage")
+    parser.add_argument("--sizes", nargs="+", default=["512x512", "2048x2048", "4096x4096"])
+    parser.add_argument("--window-sizes", nargs="+", type=int, default=[15, 51, 151])
+    parser.add_argument("--k", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="допустимое расхождение порогов")
+    args = parser.parse_args()
+
+    results, ok = [], True
+    for size in args.sizes:
+        image = make_document(*parse_size(size))
+        for window_size in args.window_sizes:
+            reference, skimage_time, skimage_peak = measure(
+                lambda: filters.threshold_niblack(image, window_size=window_size, k=args.k), args.repeat)
+            threshold, engine_time, engine_peak = measure(
+                lambda: threshold_niblack(image, window_size, args.k), args.repeat)
+            mask, mask_time, mask_peak = measure(lambda: niblack_mask(image, window_size, args.k), args.repeat)
+            max_diff = float(np.abs(reference - threshold).max())
+            # пиксели, равные порогу с точностью до округления, могут попасть в разные классы
+            mismatched = int(((image > reference) != mask).sum())
+            near_threshold = int((np.abs(image - reference) <= args.tolerance).sum())
+            passed = max_diff <= args.tolerance and mismatched <= near_threshold
+            ok = ok and passed
+            results.append({
+                "size": size, "window_size": window_size, "k": args.k,
+                "max_threshold_diff": max_diff, "mismatched_pixels": mismatched, "passed": passed,
+                "skimage": {"seconds": round(skimage_time, 4), "peak_mb": round(skimage_peak / 2 ** 20, 1)},
+                "threshold": {"seconds": round(engine_time, 4), "peak_mb": round(engine_peak / 2 ** 20, 1)},
+                "mask": {"seconds": round(mask_time, 4), "peak_mb": round(mask_peak / 2 ** 20, 1)},
+                "speedup": round(skimage_time / mask_time, 2),
+            })
+    print(json.dumps(results, indent=4))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+import numpy as np
+import PIL
+from app.core.config import settings
+from benchmarks.decode import FORMATS, proc_status_kb, write_sample
+from benchmarks.synthetic import make_document, parse_size
+
+# производительность всего пути бинаризации на синтетических документах от миниатюры до 100+ мегапикселей:
+# время и МП/с каждой стадии (base64, декодирование, оттенки серого, порог, упаковка маски, PNG, base64 результата)
+# и эндпоинтов через ASGI-клиент в том же процессе, пик RSS; JSON для сравнения между коммитами
+# запуск из директории project: python -m benchmarks.pipeline --output results.json
+
+SIZES = ["120x160", "768x1024", "2480x3508", "4960x7016", "9000x12000"]  # миниатюра, 0.8, 8.7 (A4, 300 dpi), 35, 108 МП
+STAGES = ("base64_decode", "image_decode", "grayscale", "threshold", "pack", "png_encode", "base64_encode")
+ENDPOINTS = ("json", "file", "raw")
+
+def peak_rss_mb() -> float:  # пик RSS этого процесса с его запуска
+    return round(proc_status_kb("VmHWM") / 1024, 1)
+
+def run_stages(data: bytes, args) -> dict:
+    # стадии по очереди теми же функциями, что и сервис; маски всех полос собираются до упаковки,
+    # чтобы порог и упаковка замерялись отдельно
+    from app.services.image_processing import (decode_base64_image, encode_base64, open_image, check_image,
+                                               validate_algorithm)
+    from app.services.tiling import iter_mask_strips, write_bilevel_png
+    algorithm = validate_algorithm(args.algorithm)
+    image_base64 = encode_base64(data)  # вход, как его присылает клиент
+    best, rss = {stage: float("inf") for stage in STAGES}, {}
+    for _ in range(args.repeat):
+        seconds = {}
+        start = time.perf_counter()
+        image_data = decode_base64_image(image_base64)
+        seconds["base64_decode"] = time.perf_counter() - start
+        rss["base64_decode"] = peak_rss_mb()
+
+        start = time.perf_counter()  # как load_grayscale, но декодирование и перевод в L замеряются отдельно
+        image = open_image(image_data)
+        check_image(image, algorithm, args.window_size)
+        if image.format == "JPEG" and image.mode == "RGB":
+            image.draft("L", None)  # декодер JPEG сразу отдает яркость: отдельной стадии перевода нет
+        image.load()
+        seconds["image_decode"] = time.perf_counter() - start
+        rss["image_decode"] = peak_rss_mb()
+        start = time.perf_counter()
+        gray = image if image.mode == "L" else image.convert("L")
+        seconds["grayscale"] = time.perf_counter() - start
+        rss["grayscale"] = peak_rss_mb()
+        del image, image_data
+
+        start = time.perf_counter()
+        masks = [mask for _, mask in iter_mask_strips(gray, algorithm, args.window_size, args.k,
+                                                      settings.BINARIZATION_MEMORY_BUDGET)]
+        seconds["threshold"] = time.perf_counter() - start
+        rss["threshold"] = peak_rss_mb()
+        start = time.perf_counter()
+        packed = [np.packbits(mask, axis=1) for mask in masks]
+        seconds["pack"] = time.perf_counter() - start
+        rss["pack"] = peak_rss_mb()
+        del masks
+
+        start = time.perf_counter()
+        out = BytesIO()
+        write_bilevel_png(out, gray.size[0], gray.size[1], packed)
+        result = out.getvalue()
+        seconds["png_encode"] = time.perf_counter() - start
+        rss["png_encode"] = peak_rss_mb()
+        del packed, out, gray
+
+        start = time.perf_counter()
+        encode_base64(result)
+        seconds["base64_encode"] = time.perf_counter() - start
+        rss["base64_encode"] = peak_rss_mb()
+        for stage in STAGES:
+            best[stage] = min(best[stage], seconds[stage])
+    return {"timings": {stage: {"seconds": round(best[stage], 5), "peak_rss_mb": rss[stage]} for stage in STAGES},
+            "result_bytes": len(result), "peak_rss_mb": peak_rss_mb()}
+
+async def run_endpoints(data: bytes, args) -> dict:
+    # эндпоинты приложения через httpx.ASGITransport: HTTP-разбор и ответ в этом процессе, бинаризация - в пуле
+    import httpx
+    from app.main import app
+    from app.services.image_processing import encode_base64
+    from app.services.result_cache import result_cache
+    from app.services.worker_pool import shutdown_pool
+    if not args.cache:  # повторы не должны попадать в кеш результатов
+        result_cache.memory_bytes, result_cache.disk_dir = 0, None
+    params = {"algorithm": args.algorithm, "window_size": args.window_size, "k": args.k}
+    warmup = BytesIO()
+    write_sample(warmup, "png-l", make_document(64, 64))  # процессы пула запускаются до загрузки большого изображения
+    results = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as client:
+        await client.post("/image/binary_image/raw", params=params, content=warmup.getvalue())
+        body = json.dumps({"image": encode_base64(data), **params}).encode()
+        requests = {
+            "json": lambda: client.post("/image/binary_image/json", content=body,
+                                        headers={"content-type": "application/json"}),
+            "file": lambda: client.post("/image/binary_image", files={"image": ("image", data)},
+                                        data={key: str(value) for key, value in params.items()}),
+            "raw": lambda: client.post("/image/binary_image/raw", params=params, content=data),
+        }
+        for name in ENDPOINTS:
+            best, status = float("inf"), None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = await requests[name]()
+                best = min(best, time.perf_counter() - start)
+                status = response.status_code
+                if status != 200:
+                    break
+            results[name] = {"seconds": round(best, 5), "status": status, "response_bytes": len(response.content)}
+    shutdown_pool()  # ru_maxrss завершенных процессов пула
+    return {"requests": results, "peak_rss_mb": peak_rss_mb(),
+            "workers_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+def run_child(args):  # замер в отдельном процессе: пик RSS относится только к одному изображению
+    mode, path = args.child
+    with open(path, "rb") as f:
+        data = f.read()
+    result = run_stages(data, args) if mode == "stages" else asyncio.run(run_endpoints(data, args))
+    print(json.dumps(result))
+
+def child(mode: str, path: str, args) -> dict:
+    command = [sys.executable, "-m", "benchmarks.pipeline", "--child", mode, path, "--repeat", str(args.repeat),
+               "--algorithm", args.algorithm, "--window-size", str(args.window_size), "--k", str(args.k)]
+    if args.cache:
+        command.append("--cache")
+    output = subprocess.run(command, capture_output=True, text=True)
+    if output.returncode != 0:
+        return {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed"}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def add_throughput(timings: dict, megapixels: float):  # МП/с рядом с каждым временем
+    for value in timings.values():
+        if value.get("seconds"):
+            value["mp_per_s"] = round(megapixels / value["seconds"], 2)
+
+def metadata(args) -> dict:  # окружение замера: коммит, версии, параметры
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__, "pillow": PIL.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(), "workers": settings.BINARIZATION_WORKERS,
+            "memory_budget": settings.BINARIZATION_MEMORY_BUDGET, "algorithm": args.algorithm,
+            "window_size": args.window_size, "k": args.k, "input_format": args.input_format,
+            "repeat": args.repeat, "cache": args.cache}
+
+def main():
+    parser = argparse.ArgumentParser(description="Производительность пути бинаризации по стадиям и эндпоинтам")
+    parser.add_argument("--sizes", nargs="+", default=SIZES, help="размеры ВЫСОТАxШИРИНА")
+    parser.add_argument("--input-format", default="jpeg-rgb", choices=FORMATS)
+    parser.add_argument("--algorithm", default="niblack")
+    parser.add_argument("--window-size", type=int, default=15)
+    parser.add_argument("--k", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=3, help="лучшее время из стольких повторов")
+    parser.add_argument("--skip-endpoints", action="store_true", help="только стадии")
+    parser.add_argument("--cache", action="store_true", help="не отключать кеш результатов в замере эндпоинтов")
+    parser.add_argument("--output", help="записать результат в файл JSON")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            height, width = parse_size(size)
+            path = os.path.join(directory, f"{size}.{args.input_format}")
+            write_sample(path, args.input_format, make_document(height, width))
+            megapixels = height * width / 1e6
+            line = {"size": size, "megapixels": round(megapixels, 3), "input_bytes": os.path.getsize(path)}
+            line["stages"] = child("stages", path, args)
+            if "timings" in line["stages"]:
+                timings = line["stages"]["timings"]
+                timings["total"] = {"seconds": round(sum(value["seconds"] for value in timings.values()), 5)}
+                add_throughput(timings, megapixels)
+            if not args.skip_endpoints:
+                line["endpoints"] = child("endpoints", path, args)
+                if "requests" in line["endpoints"]:
+                    add_throughput(line["endpoints"]["requests"], megapixels)
+            os.unlink(path)
+            results.append(line)
+            print(f"{size}: done", file=sys.stderr)
+    output = json.dumps({"meta": metadata(args), "results": results}, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import numpy as np
+
+BAND_ROWS = 1024  # строк шума за раз
+
+def make_document(height: int, width: int, seed: int = 0) -> np.ndarray:
+    # серое изображение, похожее на скан документа: неровная подсветка, шум и строки темных "букв"
+    # шум генерируется полосами строк: для изображений в сотни мегапикселей не нужен массив float64 целиком
+    rng = np.random.default_rng(seed)
+    rows = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    cols = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    image = np.empty((height, width), dtype=np.float32)
+    for start in range(0, height, BAND_ROWS):
+        stop = min(start + BAND_ROWS, height)
+        image[start:stop] = 200 + 30 * rows[start:stop] - 25 * cols  # подсветка меняется по листу
+        image[start:stop] += rng.normal(0, 6, (stop - start, width)).astype(np.float32)
+    line_height = max(8, height // 60)
+    for top in range(line_height, height - line_height, line_height * 2):  # строки текста
+        left = int(rng.integers(0, max(1, width // 20)))
+        while left < width - line_height:
+            letter = int(rng.integers(line_height // 3, line_height)) or 1
+            if rng.random() < 0.85:  # буква, иначе пробел
+                image[top:top + line_height, left:left + letter] -= rng.uniform(90, 150)
+            left += letter + max(1, line_height // 4)
+    return np.clip(image, 0, 255, out=image).astype(np.uint8)
+
+def parse_size(size: str) -> tuple[int, int]:  # "ВЫСОТАxШИРИНА"
+    height, width = size.lower().split("x")
+    return int(height), int(width)
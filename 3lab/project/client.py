@@ -2,7 +2,6 @@ import argparse
 import asyncio
 import json
 import aiohttp
-import base64
 import os
 import sys
 import logging
@@ -212,17 +211,6 @@ async def run_interactive_mode():
                             logger.error("Invalid format. Use: binarize file:<path> [algorithm]")
                             continue
 
-                        if len(image_base64) % 4 != 0:
-                            missing_padding = (4 - len(image_base64) % 4) % 4
-                            image_base64 += "=" * missing_padding
-                            logger.info(f"Added padding, new length: {len(image_base64)}")
-
-                        try:
-                            base64.b64decode(image_base64, validate=True)
-                        except base64.binascii.Error as e:
-                            logger.error(f"Invalid base64 string: {str(e)}")
-                            continue
-
                         message = json.dumps({
                             "action": "binarize_image",
                             "image": image_base64,
@@ -339,17 +327,6 @@ async def run_script_mode(script_file: str):
                         logger.error("Invalid format. Use: binarize file:<path> [algorithm]")
                         continue
 
-                    if len(image_base64) % 4 != 0:
-                        missing_padding = (4 - len(image_base64) % 4) % 4
-                        image_base64 += "=" * missing_padding
-                        logger.info(f"Added padding, new length: {len(image_base64)}")
-
-                    try:
-                        base64.b64decode(image_base64, validate=True)
-                    except base64.binascii.Error as e:
-                        logger.error(f"Invalid base64 string: {str(e)}")
-                        continue
-
                     message = json.dumps({
                         "action": "binarize_image",
                         "image": image_base64,